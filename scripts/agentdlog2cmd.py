@@ -24,51 +24,76 @@ in the log file.
 A new run() function is created each time a new startup of the nuvo process is detected.
 
 This tool is sensitive to changes and additions to the Nuvo API and the format of agentd.log.
-When changes are made this tool may break or produce incorrect output.
+When changes are made this tool may break or produce incorrect output. The nuvo API calls are
+defined in nuvoapi_schema.json, where APIs and parameters can be added or changed.
 """
+import argparse
+import array
+import bz2
+import calendar
+import collections
+import csv
+import cStringIO
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import mmap
+import multiprocessing
 import sys
 import os
 import re
+import time
+from uuid import uuid4
 
-#GetVolumeManifest is the agentd.log name for the Manifest API.
-API_DICT = {'FormatDevice': {'cmd': 'format-device', \
-            'params': [' --device-uuid ', ' --device ', ' --parcel-size ']}, \
-            'UseDevice': {'cmd': 'use-device', 'params': [' --device-uuid ', ' --device ']}, \
-            'CloseDevice': {'cmd': 'close-device', 'params': [' --device-uuid ']}, \
-            'NodeLocation': {'cmd': 'node-location', \
-            'params': [' --node-uuid ', ' --ipv4-addr ', ' --port ']}, \
-            'DeviceLocation': {'cmd': 'device-location', \
-            'params': [' --device-uuid ', ' --node-uuid ']}, \
-            'UseCacheDevice': {'cmd': 'use-cache-device', \
-            'params': [' --device-uuid ', ' --device ']}, \
-            'AllocCache': {'cmd': 'alloc-cache', 'params': [' --vol-series ', ' --number ']},
-            'CreateLogVol': {'cmd': 'create-volume', \
-            'params': [' --vol-series ', ' --root-device ', ' --root-parcel ', ' --size ']}, \
-            'DestroyVol': {'cmd': 'destroy-volume', \
-            'params': [' --vol-series ', ' --root-device ', ' --root-parcel ']}, \
-            'ExportLun': {'cmd': 'export', \
-            'params': [' --vol-series ', ' --pit ', ' --export-name ', ' --readonly ']}, \
-            'UnexportLun': {'cmd': 'unexport', \
-            'params': [' --vol-series ', ' --pit ', ' --export-name ']}, \
-            'AllocParcels': {'cmd': 'alloc-parcels', \
-            'params': [' --vol-series ', ' --device-uuid ', ' --number ']}, \
-            'CloseVol': {'cmd': 'close-volume', 'params': [' --vol-series ']}, \
-            'OpenVol': {'cmd': 'open-volume', \
-            'params': [' --vol-series ', ' --root-device ', ' --root-parcel ']}, \
-            'CreatePit': {'cmd': 'create-pit', 'params': [' --vol-uuid ', ' --pit-uuid ']}, \
-            'DeletePit': {'cmd': 'delete-pit', 'params': [' --vol-uuid ', ' --pit-uuid ']}, \
-            'PauseIo': {'cmd': 'pause-io', 'params': [' --vol-uuid ']}, \
-            'ResumeIo': {'cmd': 'resume-io', 'params': [' --vol-uuid ']}, \
-            'ListPits': {'cmd': 'list-pits', 'params': [' --vol-uuid ']}, \
-            'GetStats': {'cmd': 'get-stats', \
-            'params': ['is_device', 'is_read', ' --clear ', ' --device-uuid ']}, \
-            'GetVolumeStats': {'cmd': 'get-vol-stats', \
-            'params': [' --clear ', ' --volume-uuid ']}, \
-            'LogLevel': {'cmd': 'log-level', 'params': [' --module-name ', ' --log-level ']}, \
-            'LogSummary': {'cmd': 'log-summary', \
-            'params': [' --volume ', ' --parcel-index ', ' --segment-index ']}, \
-            'GetVolumeManifest': {'cmd': 'manifest', \
-            'params': [' --short ', ' --volume-uuid ', ' --file-name ']}}
+# The NUVOAPI calls are defined by a schema file, see load_schema.
+# GetVolumeManifest is the agentd.log name for the Manifest API.
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nuvoapi_schema.json')
+SCHEMA_VERSION = 1
+# The types of the parameters that are substituted, and the API handlers
+PARAM_TYPES = ['value', 'volume', 'pit', 'device', 'node', 'address', 'export-name', 'readonly']
+API_HANDLERS = [None, 'export', 'stats']
+# The schema compiled by load_schema, api -> {'cmd': the nuvo_vm command,
+# 'handler': the API handler or None, 'args': [(index, option, type, substitution function)],
+# 'names': the parameter names, 'volume': the index of the volume parameter or None}
+API_DICT = {}
+
+# Only lines that contain one of these are of interest, all others are skipped
+# before any other parsing.
+API_PREFIX = 'NUVOAPI'
+STARTUP_MSG = 'Successfully set nuvo service node UUID'
+# This message in the log means agentd gave up on nuvo
+NOT_INITIALIZED_MSG = 'NUVOAPI NOT INITIALIZED'
+
+# The patterns used to parse the lines, compiled once.
+# A NUVOAPI entry names the API, which is looked up in API_DICT, followed by at least one
+# character, usually the parameter list.
+API_CALL_RE = re.compile(r"NUVOAPI ([A-Za-z]+)(?=.)")
+STARTUP_RE = re.compile(STARTUP_MSG + r".*")
+NODE_UUID_RE = re.compile(r"\[.*\]")
+METRICS_RE = re.compile(r"NUVOAPI Metrics on (Storage|Volume).*")
+PARAMS_RE = re.compile(r"\(.*\)")
+GET_STATS_CALL_RE = re.compile(r"\(.*\).(R|W)$")
+STATS_FOR_RE = re.compile(r"(for.(read|write))")
+USABLE_SIZE_RE = re.compile(r"usableSizeBytes:.*\ ")
+ERROR_MSG_RE = re.compile(r"(failed:|error:).*")
+API_ERROR_RE = re.compile(r"(What:).*")
+# The log field of an agentd-json.log line is between these
+JSON_LOG_START = '{"log":"'
+JSON_LOG_END = '","stream":"'
+# Entries that also contain this are agentd's own state changes, not nuvo API calls.
+API_IGNORE = 'volumeSeriesRequestState'
+
+# Compressed logs, recognized by their magic bytes: (magic, function that opens the file)
+COMPRESSION = [('\x1f\x8b', gzip.GzipFile), ('BZh', bz2.BZ2File)]
+# The time stamp at the start of an agentd.log line, which is also the first in an
+# agentd-json.log line. Logs are read in the order of their first time stamp.
+TIME_RE = re.compile(r"\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d(\.\d+)?")
+# How many lines at the start of a log are searched for a time stamp
+TIME_LINES = 1000
+# The seconds since the epoch of the last second converted by log_time(), {stamp[:19]: seconds}
+SECOND_CACHE = {}
 
 NUVO_CMD = '$NUVO_VM_CMD '
 DEF_VARS = {'NUVO_SOCKET': '"/var/run/nuvoloso/nuvo.sock"',
@@ -79,96 +104,1154 @@ DEF_VARS = {'NUVO_SOCKET': '"/var/run/nuvoloso/nuvo.sock"',
 V_UUIDS = {}
 PIT_UUIDS = {}
 D_DEVICES = {}
+# DEV_MAP assignments, in the order the devices were found
+DEV_DECLS = []
 E_NAMES = {}
-D_RD_STATS = {}
-D_WR_STATS = {}
-V_RD_STATS = {}
-V_WR_STATS = {}
+# Ordered, so that the statistics are printed in the order the UUIDs were first seen
+D_RD_STATS = collections.OrderedDict()
+D_WR_STATS = collections.OrderedDict()
+V_RD_STATS = collections.OrderedDict()
+V_WR_STATS = collections.OrderedDict()
+# With --stats-csv or --stats-summary every metrics sample is kept:
+# (run, 'Storage' or 'Volume', uuid, 'READ' or 'WRITE') -> (times, I/O counts, byte counts)
+# The run is -1 before the first startup.
+KEEP_SAMPLES = False
+SAMPLES = collections.OrderedDict()
+# The percentiles of the interval rates reported by --stats-summary
+STATS_PERCENTILES = [50, 95, 99]
+STATS_CSV_FIELDS = ['run', 'type', 'uuid', 'direction', 'time', 'seconds', 'ios', 'bytes',
+                    'iops', 'bytes_per_sec', 'avg_io_size']
+# With --latency each NUVOAPI call is paired with its succeeded or failed line.
+# (api, parameters) -> (call time, index of its command in COMMANDS) for the calls in progress
+LATENCY = False
+PENDING = {}
+# (run, api) -> [histogram, calls, maximum, slow calls], latencies in microseconds.
+# The histograms are log-linear like HdrHistogram: {bucket: calls}, where each power of two
+# is split into 2**(LATENCY_SUB_BITS - 1) buckets, so a percentile is within about 3% and
+# the memory used doesn't grow with the number of calls.
+LATENCY_STATS = collections.OrderedDict()
+LATENCY_SUB_BITS = 6
+# The calls that stall I/O or the control plane, they are flagged in the script when slow
+SLOW_APIS = ['CreatePit', 'PauseIo', 'OpenVol']
+SLOW_MS = 1000
 COMMANDS = []
+# (time of the log line or None, volume UUID, call record or None) for each of the COMMANDS,
+# used to replay them. The volume is None for a command that doesn't belong to a volume, and
+# False for a command that goes with the one before it.
+COMMAND_INFO = []
+# With --calls the call records are written to this file, one JSON object per line, for
+# replay and analysis tools. In a --jobs worker it is a buffer for the records of the segment.
+CALL_FILE = None
+# With --replay-timing the time between the calls in the log is kept, divided by the
+# REPLAY_SPEED script variable. Shorter gaps than REPLAY_MIN_GAP seconds are ignored.
+REPLAY = False
+REPLAY_MIN_GAP = 0.001
+# With --concurrent-volumes the calls of each volume run as a background job, until the next
+# call that isn't for a volume.
+CONCURRENT = False
 SUPPRESS_STATS = True
 SUB_VOLUME_AND_PIT_UUIDS = True
+# In a --jobs worker the UUIDs of a segment of the log, in the order they were first seen.
+# The variables are numbered across the whole log, so the worker outputs a placeholder
+# that the main process replaces once it has numbered the variables of the earlier segments.
+SEGMENT_UUIDS = None
+SEGMENT_VAR_RE = re.compile(r"\0(VOL|PIT|NODE)\0([^\0]*)\0")
+# With --bundle the logs of several nodes are processed, one worker per node, into a script
+# for each node. The node UUIDs are substituted by NODE{#} variables and the node addresses
+# looked up in NODE_ADDR, which are shared by the nodes with the VOL and PIT variables.
+MULTI_NODE = False
+NODE_UUIDS = {}
+# The calls of a node for the timeline, as tuples, which the workers return much faster:
+# (run, time, api, volume, ((parameter name, value), ...), failure message or None)
+CALL_RECORDS = []
+BUNDLE_VARS = 'vars.sh'
+BUNDLE_TIMELINE = 'timeline.txt'
+# The APIs that use a device of the node making the call
+LOCAL_DEVICE_APIS = ['FormatDevice', 'UseDevice', 'UseCacheDevice']
+# With --checkpoint the state after the last complete line of the log is saved, so that the
+# next run only processes the lines appended since. The open run's commands are saved rather
+# than output, and the next run truncates the output before them and continues it.
+# The checkpoint is JSON, in which the strings of the log are stored as Latin-1 so that any
+# bytes in them are restored unchanged.
+CHECKPOINT_VERSION = 2
+CHECKPOINT_STATE = ['V_UUIDS', 'PIT_UUIDS', 'D_DEVICES', 'DEV_DECLS', 'E_NAMES',
+                    'D_RD_STATS', 'D_WR_STATS', 'V_RD_STATS', 'V_WR_STATS', 'SAMPLES',
+                    'PENDING', 'LATENCY_STATS', 'COMMANDS', 'COMMAND_INFO']
+# How many bytes at the start of the log identify it, to detect that it was rotated
+CHECKPOINT_HEAD = 4096
+
+DESCRIPTION = """\
+This tool processes an agentd.log file and produces a script to
+reproduce the sequence nuvo API calls.
+This tool can process both agentd.log and agentd-json.log files.
+If you have multiple agentd.log files, for example rotated ones, give
+them all. They are read as one log in the order of their first time
+stamp, and may be gzip or bzip2 compressed.
+There are inline comments added to the script output when a failed
+command was encountered.
+A new run() function is created each time a new startup of the nuvo
+process is detected, and is output as soon as that run ends.
+The device map and the volume and PiT UUID substitution variables are
+output at the end of the script, or to the --vars-file which the
+script sources.
+By default the script will execute only the run0() function.
+With --bundle the files are the logs of different nodes, and a script
+for each node, the variables they share and a timeline of the calls
+of all the nodes are written to a directory."""
+
+KNOWN_ISSUES = """\
+Known Issues:
+  The statistics summary is calculated across all runs, use --stats-summary
+  or --stats-csv for the statistics of each run.
+  Metrics samples are assumed to be running totals. A sample lower than the
+  one before it is taken to follow a clear of the statistics.
+  Volume statistics are incomplete.
+  Detection of errors in agentd.log is limited to the nuvo API commands.
+  Some errors may not be detected.
+  With --bundle the scripts of the nodes are not synchronized with each
+  other, use the timeline to run them in step.
+  This tool is sensitive to changes and additions to the Nuvo API
+  and the format of agentd.log. When changes are made this tool may break
+  or produce incorrect output. The NUVOAPI calls and their parameters are
+  defined by the --schema file, which can be changed for a new Nuvo API."""
 
 def main():
     """ Processes the log file
     """
-    if len(sys.argv) != 2:
-        usage()
-        sys.exit()
+    global KEEP_SAMPLES, LATENCY, SLOW_MS, REPLAY, CONCURRENT, CALL_FILE
+    parser = argparse.ArgumentParser(description=DESCRIPTION, epilog=KNOWN_ISSUES,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', metavar='file',
+                        help='The agentd.log or agentd-json.log files. With --bundle, the log ' +
+                        'or a directory of logs of each node, as [NAME=]PATH')
+    parser.add_argument('--vars-file', metavar='FILE',
+                        help='Write the device map and the UUID substitution variables to FILE, ' +
+                        'which the script sources, instead of at the end of the script')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Split the log at the nuvo startups and process the runs in this ' +
+                        'many worker processes. Default: 1')
+    parser.add_argument('--stats-summary', action='store_true',
+                        help='Add the percentiles of the IOPS, throughput and average I/O size ' +
+                        'between the metrics samples of each run, device and volume to the script')
+    parser.add_argument('--stats-csv', metavar='FILE',
+                        help='Write the IOPS, throughput and average I/O size between the ' +
+                        'metrics samples of each run, device and volume to a CSV FILE')
+    parser.add_argument('--latency', action='store_true',
+                        help='Pair the NUVOAPI calls with their completions, add the p50, p99 ' +
+                        'and maximum latency of each API in each run to the script and flag ' +
+                        'slow {} calls'.format(', '.join(SLOW_APIS)))
+    parser.add_argument('--slow-ms', type=int, default=SLOW_MS,
+                        help='With --latency, the latency in milliseconds above which a call ' +
+                        'is slow. Default: %d' % SLOW_MS)
+    parser.add_argument('--replay-timing', action='store_true',
+                        help='Sleep between the calls for the time between them in the log, ' +
+                        'divided by the REPLAY_SPEED script variable')
+    parser.add_argument('--replay-speed', type=float, default=1, metavar='SPEED',
+                        help='The default REPLAY_SPEED of the script: 1 replays the calls at ' +
+                        'the pace of the log, N N times faster and 0 without sleeping. Default: 1')
+    parser.add_argument('--concurrent-volumes', action='store_true',
+                        help='Run the calls of each volume as a background job, with the calls ' +
+                        'that are not for a volume waiting for all the jobs')
+    parser.add_argument('--calls', metavar='FILE',
+                        help='Also write the calls of the script to FILE, one JSON object per ' +
+                        'line with the run, time, API, volume and parameters')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='Write the script to FILE instead of the standard output')
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help='Save the state at the end of the log to FILE. If FILE exists, ' +
+                        'only process the lines appended to the log since and extend the ' +
+                        '--output script. Takes a single uncompressed log file')
+    parser.add_argument('--schema', metavar='FILE', default=SCHEMA_FILE,
+                        help='The schema of the NUVOAPI calls. Default: %s' % SCHEMA_FILE)
+    parser.add_argument('--bundle', metavar='DIR',
+                        help='Process the logs of several nodes in parallel, one worker per ' +
+                        'node up to --jobs, and write a script for each node, the variables ' +
+                        'they share and a timeline of the calls of all the nodes to DIR')
+    args = parser.parse_args()
+    try:
+        load_schema(args.schema)
+    except (IOError, ValueError) as err:
+        parser.error('invalid schema {}: {}'.format(args.schema, err))
+    if args.bundle:
+        for option in ('checkpoint', 'output', 'vars_file', 'stats_csv', 'calls'):
+            if getattr(args, option):
+                parser.error('--%s can not be used with --bundle' % option.replace('_', '-'))
+        nodes = node_logs(args.files, parser)
     else:
-        filepath = sys.argv[1]
-        if not os.path.isfile(filepath):
-            sys.stderr.write("Input file not found.\n")
-            usage()
-            sys.exit()
+        for path in args.files:
+            if not os.path.isfile(path):
+                parser.error('input file not found: %s' % path)
+    if args.checkpoint:
+        if not args.output:
+            parser.error('--checkpoint requires --output')
+        if len(args.files) > 1 or is_compressed(args.files[0]):
+            parser.error('--checkpoint takes a single uncompressed log file')
+        if args.jobs > 1:
+            parser.error('--checkpoint can not be used with --jobs')
+    KEEP_SAMPLES = bool(args.stats_summary or args.stats_csv)
+    LATENCY = args.latency
+    SLOW_MS = args.slow_ms
+    REPLAY = args.replay_timing
+    CONCURRENT = args.concurrent_volumes
+    checkpoint = load_checkpoint(args) if args.checkpoint else None
+    if args.output:
+        sys.stdout = resume_file(args.output, checkpoint and checkpoint['output'])
+    if args.calls:
+        CALL_FILE = resume_file(args.calls, checkpoint and checkpoint['calls'])
+    if args.bundle:
+        process_bundle(args, nodes)
+        return
+
+    if not checkpoint:
+        print_header(args)
+
+    paths = order_logs(args.files)
+    startups = 0
+    work, total = split_logs(paths) if args.jobs > 1 else ([], 0)
+    if total:
+        process_parallel(work, args.jobs)
+        startups = total
+    elif args.checkpoint:
+        start = 0
+        if checkpoint:
+            start, startups = checkpoint['offset'], checkpoint['startups']
+            restore_state(checkpoint['state'])
+        end = complete_size(paths[0])
+        startups = process_log(paths[0], startups, start, end)
+        save_checkpoint(args, end, startups)
+    else:
+        for path in paths:
+            startups = process_log(path, startups)
+
+    if startups == 0:
+        print_partial_start()
+    print_trailer(args, startups)
+
+def load_schema(path):
+    """Loads the NUVOAPI schema file and compiles it into API_DICT, so that a call is turned
+       into a command without searching its parameters. Raises ValueError if the schema is
+       not valid.
+
+       Parameters:
+            path - the schema file
+    """
+    with open(path) as filep:
+        schema = json.load(filep)
+    if not isinstance(schema, dict) or schema.get('version') != SCHEMA_VERSION:
+        raise ValueError('not a version {} schema'.format(SCHEMA_VERSION))
+    apis = {}
+    for api, api_def in schema.get('apis', {}).items():
+        try:
+            handler = api_def.get('handler')
+            if handler not in API_HANDLERS:
+                raise ValueError('unknown handler {}'.format(handler))
+            args = []
+            names = []
+            v_idx = None
+            for idx, param in enumerate(api_def['params']):
+                if not isinstance(param, dict):
+                    param = {'name': param}
+                name, param_type = param['name'].encode('utf-8'), param.get('type', 'value')
+                if param_type not in PARAM_TYPES:
+                    raise ValueError('unknown type {} of {}'.format(param_type, name))
+                if param_type == 'volume' and v_idx is None:
+                    v_idx = idx
+                sub = {'volume': v_sub, 'pit': pit_sub, 'device': d_sub, 'node': node_sub,
+                       'address': addr_sub}.get(param_type)
+                args.append((idx, ' --{} '.format(name), param_type, sub))
+                names.append(name)
+            if handler == 'export' and v_idx is None:
+                raise ValueError('no volume parameter')
+            apis[api.encode('utf-8')] = {'cmd': api_def['cmd'].encode('utf-8'),
+                                         'handler': handler, 'args': args, 'names': names,
+                                         'volume': v_idx}
+        except KeyError as err:
+            raise ValueError('{}: no {}'.format(api, err))
+        except (TypeError, AttributeError):
+            raise ValueError('{}: invalid definition'.format(api))
+        except ValueError as err:
+            raise ValueError('{}: {}'.format(api, err))
+    API_DICT.clear()
+    API_DICT.update(apis)
+
+def print_header(args):
+    """Prints the start of the script, up to the run functions
 
+       Parameters:
+            args - the command line arguments
+    """
     print "#!/bin/bash\n"
     print_vars()
+    if REPLAY:
+        print_replay_fns(args.replay_speed)
     print_mount_fns()
-    print "\n# Device Map\n# Substitute device paths for local environment"
 
-    startups = 0
-    with open(filepath) as filep:
-        line_str = filep.readline()
-        while line_str:
-            startups = process_line(line_str, startups)
-            line_str = filep.readline()
+def print_partial_start():
+    """Starts the function that holds the commands of a log without a nuvo startup
+    """
+    # If a partial agentd.log is provided the script may not be runnable
+    sys.stderr.write("Warning. The agentd.log file was incomplete.\n")
+    print "\n# Warning. The agentd.log file was incomplete\n"
+    print "# Partial command output is available below"
+    print "partial_nuvo_run0() {\n"
 
-    # At the end of the log file. End the last run function.
-    cmd = "\tset +ex\n\techo 'End of nuvo_vm commands'\n"
-    cmd += "}} # End nuvo_run{}()\n".format(startups - 1)
-    COMMANDS.append(cmd)
+def print_trailer(args, startups):
+    """Ends the last run function at the end of the log, and prints the tables and the
+       statistics that follow the run functions.
+
+       Parameters:
+            args - the command line arguments
+            startups - the number of startups in the log
+    """
+    if startups == 0:
+        add_command(end_run_cmd('partial_nuvo_run0'))
+    else:
+        add_command(end_run_cmd('nuvo_run{}'.format(startups - 1)))
+    print_commands()
 
-    print_v_uuids()
-    print_pit_uuids()
+    if MULTI_NODE:
+        print "\n" + "\n".join(dev_map_lines())
+        print "\n# Node, Volume and PiT UUID Substitution shared by the nodes"
+        print "source \"$(dirname \"$0\")/{}\"".format(BUNDLE_VARS)
+    else:
+        print_tables(args.vars_file)
     print_d_stats()
     print_v_stats()
+    if args.stats_summary:
+        print_rate_stats()
+    if args.stats_csv:
+        write_stats_csv(args.stats_csv)
+    if args.latency:
+        print_latency_stats()
 
-    # If a partial agentd.log is provided the script may not be runnable
-    if startups == 0:
-        sys.stderr.write("Warning. The agentd.log file was incomplete.\n")
-        print "\n# Warning. The agentd.log file was incomplete\n"
-        print "# Partial command output is available below"
-        print "partial_nuvo_run{}() {{\n".format(startups)
-    elif startups > 1:
+    if startups > 1:
         print "\n# Agentd.log shows the nuvo process was restarted {} times".format(startups - 1)
-
-    for cmd in COMMANDS:
-        print cmd
-
     if startups > 0:
         print "\n# Reproduces the first configuration found in the log"
         print "# Change the function to the run you want to reproduce"
         print "nuvo_run0\n"
 
+def end_run_cmd(name):
+    """Returns the end of a run function
+
+       Parameters:
+            name - the name of the function
+    """
+    return "\tset +ex\n\techo 'End of nuvo_vm commands'\n}} # End {}()\n".format(name)
+
+def add_command(cmd, stamp=None, volume=None, call=None):
+    """Adds a command to the current run
+
+       Parameters:
+            cmd - the command
+            stamp - the time of the log line, if the command is replayed with timing
+            volume - the volume UUID, see COMMAND_INFO
+            call - the call record for --calls
+    """
+    COMMANDS.append(cmd)
+    COMMAND_INFO.append((stamp, volume, call))
+
+def pop_command():
+    """Removes the last command of the current run. Returns the command and its time,
+       volume and call record.
+    """
+    stamp, volume, call = COMMAND_INFO.pop()
+    return COMMANDS.pop(), stamp, volume, call
+
+def call_record(run, line_str, api, params, volume):
+    """Returns the --calls record of a call
+
+       Parameters:
+            run - the current run number
+            line_str - line string
+            api - the api string
+            params - the parameters, by name
+            volume - the UUID of the volume the call is for, or None
+    """
+    return collections.OrderedDict([('run', run), ('time', log_time(line_str)), ('api', api),
+                                    ('volume', volume), ('params', params)])
+
+def call_json(call):
+    """Returns a --calls record as a line of JSON. Bytes of the log that are not valid UTF-8
+       are replaced.
+
+       Parameters:
+            call - the call record
+    """
+    try:
+        return json.dumps(call) + "\n"
+    except UnicodeDecodeError:
+        return json.dumps(utf8_replaced(call)) + "\n"
+
+def utf8_replaced(value):
+    """Returns a value with its strings decoded as UTF-8, replacing the invalid bytes
+
+       Parameters:
+            value - a string, or a dict of them
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, dict):
+        return collections.OrderedDict((utf8_replaced(key), utf8_replaced(item))
+                                       for key, item in value.items())
+    return value
+
+def print_commands():
+    """Prints the commands of the current run and discards them, so that no more
+       than one run is held in memory.
+    """
+    for cmd in replay_commands() if REPLAY or CONCURRENT else COMMANDS:
+        print cmd
+    if MULTI_NODE:
+        CALL_RECORDS.extend((call['run'], call['time'], call['api'], call['volume'],
+                             tuple(call['params'].items()), call.get('failed'))
+                            for _, _, call in COMMAND_INFO if call)
+    elif CALL_FILE:
+        for _, _, call in COMMAND_INFO:
+            if call:
+                CALL_FILE.write(call_json(call))
+        CALL_FILE.flush()
+    del COMMANDS[:]
+    del COMMAND_INFO[:]
+    sys.stdout.flush()
+
+def replay_commands():
+    """Returns the commands of the current run for --replay-timing and --concurrent-volumes.
+       A call is preceded by a sleep for the time since the call before it in the log.
+       The calls for a volume are put in a background job, which starts after the last call
+       that isn't for a volume, and so its first call sleeps for the time since that one.
+       A call that isn't for a volume first waits for the jobs.
+    """
+    lines = []
+    jobs = collections.OrderedDict()
+    group = lines
+    # The times of the last call that isn't for a volume, and of the last call
+    base = last = None
+    for cmd, (stamp, volume, _) in zip(COMMANDS, COMMAND_INFO):
+        if volume is None:
+            if jobs:
+                lines.extend(job_lines(jobs))
+                jobs.clear()
+            group, since = lines, last
+        elif volume:
+            if volume not in jobs:
+                jobs[volume] = [[], base]
+            group, since = jobs[volume]
+        if stamp is not None:
+            if REPLAY and since is not None and stamp - since >= REPLAY_MIN_GAP:
+                group.append("\treplay_sleep {:.6f}".format(stamp - since))
+            if volume:
+                jobs[volume][1] = stamp
+            else:
+                base = stamp
+            last = stamp if last is None else max(last, stamp)
+        group.append(cmd)
+    if jobs:
+        lines.extend(job_lines(jobs))
+    return lines
+
+def job_lines(jobs):
+    """Returns the lines that run the calls of each volume in a background job, and wait
+       for the jobs. A job stops at its first failed call with set -e, but a bare wait
+       returns 0, so each job is waited for and the script exits with the status of the
+       first that failed, as it would without --concurrent-volumes.
+
+       Parameters:
+            jobs - volume UUID -> [commands, time of the last call]
+    """
+    lines = ["\tpids=()"]
+    for commands, _ in jobs.values():
+        lines.append("\t{")
+        lines.extend(commands)
+        lines.append("\t} &")
+        lines.append("\tpids+=($!)")
+    lines.append('\tfor pid in "${pids[@]}"; do wait $pid || exit $?; done')
+    return lines
+
+def open_log(path):
+    """Opens a log file for reading, decompressing it as a stream if it is compressed.
+
+       Parameters:
+            path - the log file
+    """
+    with open(path, 'rb') as filep:
+        head = filep.read(4)
+    for magic, opener in COMPRESSION:
+        if head.startswith(magic):
+            filep = opener(path, 'rb')
+            if opener is gzip.GzipFile:
+                # GzipFile reads lines in Python, buffering it is much faster
+                return io.BufferedReader(filep)
+            return filep
+    return open(path, 'rb')
+
+def is_compressed(path):
+    """Checks whether a log file is compressed, and so can't be split or mapped
+    """
+    with open(path, 'rb') as filep:
+        head = filep.read(4)
+    return any(head.startswith(magic) for magic, _ in COMPRESSION)
+
+def first_time(path):
+    """Returns the first time stamp found near the start of a log file, or None.
+
+       Parameters:
+            path - the log file
+    """
+    with open_log(path) as filep:
+        for line_str in itertools.islice(filep, TIME_LINES):
+            match = TIME_RE.search(line_str)
+            if match:
+                return match.group().replace('T', ' ')
+    return None
+
+def order_logs(paths):
+    """Returns the log files in the order of their first time stamp. Files without a
+       time stamp follow the others in the given order.
+
+       Parameters:
+            paths - the log files
+    """
+    stamps = [first_time(path) for path in paths]
+    order = sorted(range(len(paths)), key=lambda i: (stamps[i] is None, stamps[i], i))
+    return [paths[i] for i in order]
+
+def is_json_log(path):
+    """Checks whether a log file is an agentd-json.log, in which each line is a docker
+       JSON log record.
+
+       Parameters:
+            path - the log file
+    """
+    with open_log(path) as filep:
+        return next(iter(filep), '').startswith('{')
+
+def process_log(path, startups, start=0, end=None):
+    """Processes the lines of a log file, or of the byte range from start to end of an
+       uncompressed one. Returns the number of startups.
+
+       Parameters:
+            path - the log file
+            startups - the number of startups before the lines
+            start - the offset of the first line
+            end - the offset after the last line, or None for the whole file
+    """
+    process = process_json_line if is_json_log(path) else process_line
+    with open_log(path) as filep:
+        if end is None:
+            for line_str in filep:
+                startups = process(line_str, startups)
+            return startups
+        filep.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            line_str = filep.readline()
+            if not line_str:
+                break
+            remaining -= len(line_str)
+            startups = process(line_str, startups)
+    return startups
+
+def split_logs(paths):
+    """Splits the logs into the segments that process_segment processes: the lines before
+       the first nuvo startup, and the lines of each run. Compressed files can't be split,
+       so they are kept in one segment, which may hold several runs.
+       Returns the work for process_segment and the number of startups.
+
+       Parameters:
+            paths - the log files, in order
+    """
+    work = []
+    pieces = []
+    before = 0
+    startups = 0
+    for path in paths:
+        if is_compressed(path):
+            pieces.append((path, 0, None))
+            with open_log(path) as filep:
+                startups += sum(1 for line_str in filep
+                                if STARTUP_MSG in line_str and is_startup(line_str))
+            continue
+        start = 0
+        for offset in find_startups(path):
+            if offset > start:
+                pieces.append((path, start, offset))
+            if pieces:
+                work.append((pieces, before))
+            pieces = []
+            before = startups
+            startups += 1
+            start = offset
+        size = os.path.getsize(path)
+        if size > start:
+            pieces.append((path, start, size))
+    if pieces:
+        work.append((pieces, before))
+    return work, startups
+
+def find_startups(path):
+    """Returns the byte offsets of the nuvo startup lines in an uncompressed file.
+
+       Parameters:
+            path - the log file
+    """
+    offsets = []
+    if not os.path.getsize(path):
+        return offsets
+    with open(path, 'rb') as filep:
+        mem = mmap.mmap(filep.fileno(), 0, access=mmap.ACCESS_READ)
+        pos = mem.find(STARTUP_MSG)
+        while pos != -1:
+            start = mem.rfind('\n', 0, pos) + 1
+            end = mem.find('\n', pos) + 1 or len(mem)
+            if is_startup(mem[start:end]):
+                offsets.append(start)
+            pos = mem.find(STARTUP_MSG, end)
+        mem.close()
+    return offsets
+
+def is_startup(line_str):
+    """Checks whether process_line will start a new run function for a line
+
+       Parameters:
+            line_str - line string
+    """
+    line_str = line_str.replace('\\n', '')
+    return STARTUP_MSG in line_str and NOT_INITIALIZED_MSG not in line_str
+
+def process_parallel(work, jobs):
+    """Processes the segments of the logs in a pool of worker processes, and outputs the
+       run functions in the log order.
+
+       Parameters:
+            work - the segments from split_logs
+            jobs - the number of worker processes
+    """
+    pool = multiprocessing.Pool(jobs)
+    for result in ordered_imap(pool, process_segment, work, 2 * jobs):
+        stitch_segment(result)
+    pool.close()
+    pool.join()
+
+def ordered_imap(pool, func, work, window):
+    """Like pool.imap, but with at most window results outstanding, so memory stays bounded
+       when the output is slower than the workers.
+    """
+    pending = collections.deque()
+    for item in work:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def process_segment(work):
+    """Processes the lines of one segment of the log, or of the logs of a node with --bundle,
+       in a worker process. Returns the output, the tables and the startups of the segment.
+
+       Parameters:
+            work - (list of (path, start offset, end offset or None for the whole file),
+                    startups before the segment)
+    """
+    global SEGMENT_UUIDS, CALL_FILE
+    pieces, startups = work
+    for table in (V_UUIDS, PIT_UUIDS, NODE_UUIDS, D_DEVICES, E_NAMES,
+                  D_RD_STATS, D_WR_STATS, V_RD_STATS, V_WR_STATS, SAMPLES,
+                  PENDING, LATENCY_STATS):
+        table.clear()
+    del DEV_DECLS[:]
+    del COMMANDS[:]
+    del COMMAND_INFO[:]
+    SEGMENT_UUIDS = []
+    del CALL_RECORDS[:]
+    if CALL_FILE:
+        CALL_FILE = cStringIO.StringIO()
+    stdout = sys.stdout
+    sys.stdout = cStringIO.StringIO()
+    try:
+        for path, start, end in pieces:
+            startups = process_log(path, startups, start, end)
+        print_commands()
+        text = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    if MULTI_NODE:
+        calls = list(CALL_RECORDS)
+    else:
+        calls = CALL_FILE.getvalue() if CALL_FILE else ''
+    return (text, SEGMENT_UUIDS, list(DEV_DECLS), D_RD_STATS, D_WR_STATS,
+            V_RD_STATS, V_WR_STATS, SAMPLES, LATENCY_STATS, calls, startups)
+
+def stitch_segment(result):
+    """Numbers the new volume and PiT variables of a segment in the order they were first
+       seen, adds the segment's tables to the global ones and outputs its commands.
+
+       Parameters:
+            result - the process_segment result
+    """
+    (text, uuids, dev_decls, d_rd_stats, d_wr_stats, v_rd_stats, v_wr_stats, samples,
+     latency_stats, calls, _) = result
+    sys.stdout.write(substitute_vars(text, uuids))
+    sys.stdout.flush()
+    if calls:
+        CALL_FILE.write(calls)
+        CALL_FILE.flush()
+    for decl_var in dev_decls:
+        basename = decl_var.split('"', 2)[1]
+        if basename not in D_DEVICES:
+            D_DEVICES[basename] = '${DEV_MAP[\"' + basename + '\"]}'
+            DEV_DECLS.append(decl_var)
+    D_RD_STATS.update(d_rd_stats)
+    D_WR_STATS.update(d_wr_stats)
+    V_RD_STATS.update(v_rd_stats)
+    V_WR_STATS.update(v_wr_stats)
+    for key, arrays in samples.items():
+        if key in SAMPLES:
+            for kept, more in zip(SAMPLES[key], arrays):
+                kept.extend(more)
+        else:
+            SAMPLES[key] = arrays
+    for key, entry in latency_stats.items():
+        merge_latency(LATENCY_STATS, key, entry)
+
+def substitute_vars(text, uuids):
+    """Numbers the new variables of a segment in the order they were first seen, and returns
+       the segment's output with the variables in place of their placeholders.
+
+       Parameters:
+            text - the output of the segment
+            uuids - the (prefix, uuid) of the variables of the segment
+    """
+    tables = {'VOL': V_UUIDS, 'PIT': PIT_UUIDS, 'NODE': NODE_UUIDS}
+    for prefix, uuid in uuids:
+        table = tables[prefix]
+        if uuid not in table:
+            table[uuid] = '{}{}'.format(prefix, len(table))
+    return SEGMENT_VAR_RE.sub(lambda m: tables[m.group(1)][m.group(2)], text)
+
+def node_logs(specs, parser):
+    """Returns the name and the log files, in order, of each node for --bundle.
+
+       Parameters:
+            specs - the file arguments, [NAME=]PATH where PATH is the log of the node or a
+                    directory of its logs, and NAME defaults to the last part of PATH
+            parser - the argument parser, to report errors
+    """
+    nodes = []
+    for spec in specs:
+        name, sep, path = spec.partition('=')
+        if not sep or os.path.exists(spec):
+            name, path = os.path.basename(os.path.normpath(spec)), spec
+        if os.path.isdir(path):
+            paths = [os.path.join(path, entry) for entry in sorted(os.listdir(path))]
+            paths = [entry for entry in paths if os.path.isfile(entry)]
+        elif os.path.isfile(path):
+            paths = [path]
+        else:
+            parser.error('input file not found: %s' % path)
+        if not paths:
+            parser.error('no log files in %s' % path)
+        if name in [node for node, _ in nodes]:
+            parser.error('more than one node is named %s, use NAME=PATH' % name)
+        nodes.append((name, order_logs(paths)))
+    return nodes
+
+def process_bundle(args, nodes):
+    """Processes the logs of each node in a worker process, and writes the script of each
+       node, the variables the scripts share and the timeline of the calls of all the nodes
+       to the --bundle directory. The variables are numbered in the order of the nodes.
+
+       Parameters:
+            args - the command line arguments
+            nodes - the name and the log files of each node
+    """
+    global MULTI_NODE
+    MULTI_NODE = True
+    if not os.path.isdir(args.bundle):
+        os.makedirs(args.bundle)
+    work = [([(path, 0, None) for path in paths], 0) for _, paths in nodes]
+    jobs = args.jobs if args.jobs > 1 else len(nodes)
+    pool = multiprocessing.Pool(jobs)
+    node_calls = []
+    for (name, _), result in zip(nodes, ordered_imap(pool, process_segment, work, 2 * jobs)):
+        write_node_script(args, os.path.join(args.bundle, name + '.sh'), result)
+        node_calls.append(result[9])
+    pool.close()
+    pool.join()
+    names = [name for name, _ in nodes]
+    write_bundle_vars(os.path.join(args.bundle, BUNDLE_VARS), names, node_calls)
+    write_timeline(os.path.join(args.bundle, BUNDLE_TIMELINE), names, node_calls)
+
+def write_node_script(args, path, result):
+    """Writes the script of a node for --bundle
+
+       Parameters:
+            args - the command line arguments
+            path - the script file
+            result - the process_segment result for the logs of the node
+    """
+    (text, uuids, dev_decls, d_rd_stats, d_wr_stats, v_rd_stats, v_wr_stats, samples,
+     latency_stats, _, startups) = result
+    text = substitute_vars(text, uuids)
+    # The trailer is the node's own
+    restore_state({'DEV_DECLS': dev_decls, 'D_RD_STATS': d_rd_stats, 'D_WR_STATS': d_wr_stats,
+                   'V_RD_STATS': v_rd_stats, 'V_WR_STATS': v_wr_stats, 'SAMPLES': samples,
+                   'LATENCY_STATS': latency_stats})
+    stdout = sys.stdout
+    sys.stdout = open(path, 'w')
+    try:
+        print_header(args)
+        if startups == 0:
+            print_partial_start()
+        sys.stdout.write(text)
+        print_trailer(args, startups)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def write_bundle_vars(path, names, node_calls):
+    """Writes the variables shared by the scripts of the nodes. The nodes must use the same
+       UUIDs, so new ones are generated once here rather than by each script.
+
+       Parameters:
+            path - the file
+            names - the names of the nodes
+            node_calls - the call records of each node
+    """
+    owners = node_owners(names, node_calls)
+    addresses = collections.OrderedDict()
+    for calls in node_calls:
+        for _, _, api, _, params, _ in calls:
+            if api == 'NodeLocation':
+                addr = dict(params).get('ipv4-addr')
+                if addr:
+                    addresses[addr] = True
+    lines = ["# Shared by the scripts of the nodes", "\n# Node UUID Substitution"]
+    for uuid, n_var in numbered(NODE_UUIDS):
+        lines.append("{}={}{}".format(n_var, uuid4(),
+                                      "  # " + owners[uuid] if uuid in owners else ""))
+    lines.extend(["\n# Node Address Map", "# Substitute node addresses for local environment",
+                  "declare -A NODE_ADDR"])
+    for addr in addresses:
+        lines.append("NODE_ADDR[\"{0}\"]='{0}'".format(addr))
+    lines.append("\n# Volume UUID Substitution")
+    for _, v_var in numbered(V_UUIDS):
+        lines.append("{}={}".format(v_var, uuid4()))
+    lines.append("\n# PiT UUID Substitution")
+    for _, p_var in numbered(PIT_UUIDS):
+        lines.append("{}={}".format(p_var, uuid4()))
+    with open(path, 'w') as filep:
+        filep.write("\n".join(lines) + "\n")
+
+def numbered(table):
+    """Returns the (UUID, variable) items of a substitution table in the order of the
+       variable numbers.
+    """
+    return sorted(table.items(), key=lambda item: int(item[1].lstrip('NODEVLPIT')))
+
+def node_owners(names, node_calls):
+    """Returns the name of the node of each node UUID set by a nuvo startup in its log
+
+       Parameters:
+            names - the names of the nodes
+            node_calls - the call records of each node
+    """
+    owners = collections.OrderedDict()
+    for name, calls in zip(names, node_calls):
+        for _, _, api, _, params, _ in calls:
+            if api == 'UseNodeUUID':
+                owners.setdefault(dict(params)['node-uuid'], name)
+    return owners
+
+def write_timeline(path, names, node_calls):
+    """Writes the calls of all the nodes in time order, after what correlate_nodes found.
+       The UUIDs are shown as the shared variables.
+
+       Parameters:
+            path - the file
+            names - the names of the nodes
+            node_calls - the call records of each node
+    """
+    events = []
+    for index, calls in enumerate(node_calls):
+        # A line without a time stamp stays after the line before it
+        stamp = None
+        for seq, call in enumerate(calls):
+            if call[1] is not None:
+                stamp = call[1]
+            events.append((stamp is None, stamp, index, seq, call))
+    events.sort(key=lambda event: event[:4])
+    width = max(len(name) for name in names)
+    with open(path, 'w') as filep:
+        for line in correlate_nodes(names, node_calls):
+            filep.write(line + "\n")
+        filep.write("\n{:<26} {:<{}} {:<5} {}\n".format("# Time (UTC)", "Node", width, "Run",
+                                                        "Call"))
+        for _, stamp, index, _, (run, _, api, _, params, failed) in events:
+            params = " ".join("{}={}".format(name, shared_var(value))
+                              for name, value in params if value)
+            line = "{} {:<{}} {:<5} {} {}".format(format_time(stamp), names[index], width,
+                                                  run, api, params)
+            if failed is not None:
+                line += "  FAILED: " + failed
+            filep.write(line + "\n")
+
+def correlate_nodes(names, node_calls):
+    """Returns comment lines that summarize how the nodes see each other: the node UUID and
+       the addresses in NodeLocation calls of each node, the NodeLocation and DeviceLocation
+       calls that disagree with the logs of the nodes, and the volumes used by more than one
+       node.
+
+       Parameters:
+            names - the names of the nodes
+            node_calls - the call records of each node
+    """
+    owners = node_owners(names, node_calls)
+    # node UUID -> address -> the nodes told the node is there
+    locations = collections.OrderedDict()
+    # device UUID -> the node that uses the device itself
+    devices = {}
+    # (device UUID, node UUID) -> the nodes told the device is on the node
+    device_locations = collections.OrderedDict()
+    # volume UUID -> node -> [first time, last time, calls]
+    volumes = collections.OrderedDict()
+    for name, calls in zip(names, node_calls):
+        for _, stamp, api, volume, params, _ in calls:
+            if api in ('NodeLocation', 'DeviceLocation') or api in LOCAL_DEVICE_APIS:
+                params = dict(params)
+            if api == 'NodeLocation':
+                told = locations.setdefault(params.get('node-uuid'), collections.OrderedDict())
+                told.setdefault(params.get('ipv4-addr'), set()).add(name)
+            elif api == 'DeviceLocation':
+                key = (params.get('device-uuid'), params.get('node-uuid'))
+                device_locations.setdefault(key, set()).add(name)
+            elif api in LOCAL_DEVICE_APIS:
+                devices.setdefault(params.get('device-uuid'), name)
+            if volume:
+                used = volumes.setdefault(volume, collections.OrderedDict())
+                entry = used.setdefault(name, [stamp, stamp, 0])
+                entry[1] = stamp if stamp is not None else entry[1]
+                entry[2] += 1
+
+    lines = ["# Nodes"]
+    for n_uuid, name in owners.items():
+        lines.append("#   {} {} {} at {}".format(name, shared_var(n_uuid), n_uuid,
+                                                 ", ".join(locations.get(n_uuid, {})) or "-"))
+    strangers = [n_uuid for n_uuid in locations if n_uuid not in owners]
+    if strangers:
+        lines.append("# Nodes in NodeLocation calls without a log")
+        for n_uuid in strangers:
+            lines.append("#   {} {} at {}".format(shared_var(n_uuid), n_uuid,
+                                                  ", ".join(locations[n_uuid])))
+    conflicts = [n_uuid for n_uuid, told in locations.items() if len(told) > 1]
+    if conflicts:
+        lines.append("# Nodes at different addresses in NodeLocation calls")
+        for n_uuid in conflicts:
+            lines.append("#   {} {}".format(shared_var(n_uuid), "; ".join(
+                "{} for {}".format(addr, ", ".join(sorted(told)))
+                for addr, told in locations[n_uuid].items())))
+    moved = [(key, told) for key, told in device_locations.items()
+             if key[0] in devices and owners.get(key[1]) != devices[key[0]]]
+    if moved:
+        lines.append("# Devices in DeviceLocation calls on another node than the one using them")
+        for (d_uuid, n_uuid), told in moved:
+            lines.append("#   {} on {} for {}, used by {}".format(
+                d_uuid, shared_var(n_uuid), ", ".join(sorted(told)), devices[d_uuid]))
+    shared = [(v_uuid, used) for v_uuid, used in volumes.items() if len(used) > 1]
+    lines.append("# Volumes used by more than one node: {}".format(len(shared)))
+    for v_uuid, used in shared:
+        lines.append("#   {} {} {}".format(shared_var(v_uuid), v_uuid, "; ".join(
+            "{} {} - {} ({} calls)".format(name, format_time(first), format_time(last), calls)
+            for name, (first, last, calls) in used.items())))
+    return lines
+
+def shared_var(value):
+    """Returns the shared variable of a volume, PiT or node UUID, or the value itself
+    """
+    for table in (V_UUIDS, PIT_UUIDS, NODE_UUIDS):
+        if value in table:
+            return '$' + table[value]
+    return value
+
+def format_time(stamp):
+    """Returns a log time in seconds since the epoch as a UTC time stamp, or - for None
+    """
+    if stamp is None:
+        return '-'
+    secs, usecs = divmod(int(round(stamp * 1000000)), 1000000)
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(secs)) + '.{:06d}'.format(usecs)
+
+def complete_size(path):
+    """Returns the offset after the last complete line of a log file. A line that is still
+       being written is left for the next run.
+
+       Parameters:
+            path - the log file
+    """
+    with open(path, 'rb') as filep:
+        end = os.path.getsize(path)
+        while end > 0:
+            start = max(0, end - io.DEFAULT_BUFFER_SIZE)
+            filep.seek(start)
+            pos = filep.read(end - start).rfind('\n')
+            if pos >= 0:
+                return start + pos + 1
+            end = start
+    return 0
+
+def log_identity(path, offset):
+    """Returns what identifies a log file of which the first offset bytes were processed:
+       its device and inode, and a hash of its first bytes.
+
+       Parameters:
+            path - the log file
+            offset - the offset processed up to
+    """
+    stat = os.stat(path)
+    with open(path, 'rb') as filep:
+        head = filep.read(min(offset, CHECKPOINT_HEAD))
+    return [stat.st_dev, stat.st_ino, hashlib.sha1(head).hexdigest()]
+
+def load_checkpoint(args):
+    """Returns the --checkpoint of an earlier run, or None if there is none or it can't be
+       continued, because the log was rotated or truncated, the options are different or
+       the output was changed. The log is then processed from the start.
+
+       Parameters:
+            args - the command line arguments
+    """
+    if not os.path.exists(args.checkpoint):
+        return None
+    try:
+        with open(args.checkpoint, 'rb') as filep:
+            checkpoint = from_json(json.load(filep, encoding='latin-1',
+                                             object_pairs_hook=collections.OrderedDict))
+        if not isinstance(checkpoint, dict):
+            checkpoint = {}
+        elif checkpoint.get('version') == CHECKPOINT_VERSION:
+            checkpoint['state'] = checkpoint_state(checkpoint['state'])
+    except (IOError, ValueError, TypeError, KeyError, AttributeError):
+        checkpoint = {}
+    path = args.files[0]
+    if checkpoint.get('version') != CHECKPOINT_VERSION:
+        reason = 'it can not be read'
+    elif checkpoint['options'] != vars(args):
+        reason = 'the options are different'
+    elif os.path.getsize(path) < checkpoint['offset']:
+        reason = 'the log was truncated'
+    elif log_identity(path, checkpoint['offset']) != checkpoint['log']:
+        reason = 'the log was rotated'
+    elif not os.path.isfile(args.output) or \
+            os.path.getsize(args.output) < checkpoint['output']:
+        reason = 'the output was changed'
+    elif args.calls and (not os.path.isfile(args.calls) or
+                         os.path.getsize(args.calls) < checkpoint['calls']):
+        reason = 'the calls file was changed'
+    else:
+        return checkpoint
+    sys.stderr.write("Not continuing from {}, {}. Processing the log from the start.\n".format(
+        args.checkpoint, reason))
+    return None
+
+def save_checkpoint(args, offset, startups):
+    """Saves the --checkpoint after the lines of the log up to offset were processed,
+       before the open run is output.
+
+       Parameters:
+            args - the command line arguments
+            offset - the offset after the last line processed
+            startups - the number of startups
+    """
+    sys.stdout.flush()
+    checkpoint = {'version': CHECKPOINT_VERSION, 'options': vars(args),
+                  'log': log_identity(args.files[0], offset), 'offset': offset,
+                  'startups': startups, 'output': sys.stdout.tell(),
+                  'calls': CALL_FILE.tell() if CALL_FILE else None,
+                  'state': checkpoint_tables()}
+    # Replace the checkpoint only once it is complete
+    tmp_path = args.checkpoint + '.tmp'
+    with open(tmp_path, 'wb') as filep:
+        json.dump(checkpoint, filep, encoding='latin-1')
+    os.rename(tmp_path, args.checkpoint)
+
+def checkpoint_tables():
+    """Returns the tables saved by --checkpoint, by global name, as JSON values. The tables
+       with tuple keys are saved as lists of rows and the arrays as lists.
+    """
+    state = dict((name, globals()[name]) for name in CHECKPOINT_STATE)
+    state['SAMPLES'] = [[list(key), [list(values) for values in arrays]]
+                        for key, arrays in SAMPLES.items()]
+    state['PENDING'] = [list(key) + list(call) for key, call in PENDING.items()]
+    state['LATENCY_STATS'] = [list(key) + [sorted(entry[0].items())] + entry[1:]
+                              for key, entry in LATENCY_STATS.items()]
+    return state
+
+def checkpoint_state(saved):
+    """Returns the tables saved by checkpoint_tables() as they were before they were saved
+
+       Parameters:
+            saved - the tables read from the checkpoint, by global name
+    """
+    state = dict((name, saved[name]) for name in CHECKPOINT_STATE)
+    state['SAMPLES'] = collections.OrderedDict(
+        (tuple(key), tuple(array.array('d', values) for values in arrays))
+        for key, arrays in saved['SAMPLES'])
+    state['PENDING'] = dict(((api, params), (stamp, index))
+                            for api, params, stamp, index in saved['PENDING'])
+    state['LATENCY_STATS'] = collections.OrderedDict(
+        ((run, api), [dict(histogram), calls, maximum, slow])
+        for run, api, histogram, calls, maximum, slow in saved['LATENCY_STATS'])
+    state['COMMAND_INFO'] = [tuple(info) for info in saved['COMMAND_INFO']]
+    return state
+
+def from_json(value):
+    """Returns a value read from a checkpoint with its strings encoded as they were saved
+
+       Parameters:
+            value - the value
+    """
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    if isinstance(value, list):
+        return [from_json(item) for item in value]
+    if isinstance(value, dict):
+        return collections.OrderedDict((from_json(key), from_json(item))
+                                       for key, item in value.items())
+    return value
+
+def restore_state(state):
+    """Restores the tables and the open run saved by save_checkpoint
+
+       Parameters:
+            state - the saved tables, by global name
+    """
+    for name, saved in state.items():
+        table = globals()[name]
+        if isinstance(table, list):
+            table[:] = saved
+            continue
+        table.clear()
+        if name in ('V_UUIDS', 'PIT_UUIDS'):
+            # Added in the order they were numbered, so that the variables are output in the
+            # same order as without the checkpoint
+            table.update(numbered(saved))
+        else:
+            table.update(saved)
+
+def resume_file(path, offset):
+    """Opens an output file. If a checkpoint is continued the file is truncated to its size
+       at the checkpoint and extended, otherwise it is replaced.
 
-def usage():
-    """ Prints a usage statement
-    """
-    sys.stderr.write("Usage:\n")
-    sys.stderr.write("  agentdlog2cmd.py agentd.log\n")
-    sys.stderr.write("Description:\n")
-    sys.stderr.write("  This tool processes an agentd.log file and produces a script to\n")
-    sys.stderr.write("  reproduce the sequence nuvo API calls.\n")
-    sys.stderr.write("  This tool can process both agentd.log and agentd-json.log files.\n")
-    sys.stderr.write("  If you have multiple agentd.log files they should be concatenated\n")
-    sys.stderr.write("  before running the tool, otherwise the output may be incomplete.\n")
-    sys.stderr.write("  There are inline comments added to the script output when a failed\n")
-    sys.stderr.write("  command was encountered.\n")
-    sys.stderr.write("  A new run() function is created each time a new startup of the nuvo\n")
-    sys.stderr.write("  process is detected.\n")
-    sys.stderr.write("  By default the script will execute only the run0() function.\n")
-    sys.stderr.write("Known Issues:\n")
-    sys.stderr.write("  The entire agentd.log file is processed before commands are output,\n")
-    sys.stderr.write("  while processing the command may appear hung.\n")
-    sys.stderr.write("  Statistics are calculated across all runs.\n")
-    sys.stderr.write("  Volume statistics are incomplete.\n")
-    sys.stderr.write("  Detection of errors in agentd.log is limited to the nuvo API commands.\n")
-    sys.stderr.write("  Some errors may not be detected.\n")
-    sys.stderr.write("  Scripting multinode configurations is not supported.\n")
-    sys.stderr.write("  You will need separate scripts generated for each node.\n")
-    sys.stderr.write("  This tool is sensitive to changes and additions to the Nuvo API\n")
-    sys.stderr.write("  and the format of agentd.log. When changes are made this tool may break\n")
-    sys.stderr.write("  or produce incorrect output.\n")
+       Parameters:
+            path - the file
+            offset - the size at the checkpoint, or None
+    """
+    if offset is None:
+        return open(path, 'wb')
+    filep = open(path, 'r+b')
+    filep.seek(offset)
+    filep.truncate()
+    return filep
 
 def print_mount_fns():
     """Adds a boilerplate mount function to the script
@@ -196,7 +1279,7 @@ def print_d_stats():
         else:
             print "#  Reads:        0\t Avg. IO Size:      0\t Total Bytes:                0"
 
-        if int(D_WR_STATS[uuid][0]) > 0:
+        if uuid in D_WR_STATS and int(D_WR_STATS[uuid][0]) > 0:
             print "# Writes: {a:8d}\t Avg. IO Size: {b:6d}\t Total Bytes: {c:16d}".format(\
             a=int(D_WR_STATS[uuid][0]), \
             b=int((int(D_WR_STATS[uuid][1])/int(D_WR_STATS[uuid][0]))), \
@@ -218,7 +1301,7 @@ def print_v_stats():
         else:
             print "#  Reads:        0\t Avg. IO Size:      0\t Total Bytes:                0"
 
-        if int(V_WR_STATS[uuid][0]) > 0:
+        if uuid in V_WR_STATS and int(V_WR_STATS[uuid][0]) > 0:
             print "# Writes: {a:8d}\t Avg. IO Size: {b:6d}\t Total Bytes: {c:16d}".format(\
             a=int(V_WR_STATS[uuid][0]), \
             b=int((int(V_WR_STATS[uuid][1])/int(V_WR_STATS[uuid][0]))), \
@@ -227,6 +1310,216 @@ def print_v_stats():
             print "#  Reads:        0\t Avg. IO Size:      0\t Total Bytes:                0"
 
 
+def log_time(line_str):
+    """Returns the time stamp at the start of a log message in seconds since the epoch,
+       or None if there is none.
+
+       Parameters:
+            line_str - the message
+    """
+    match = TIME_RE.match(line_str)
+    if not match:
+        return None
+    stamp = match.group()
+    # The metrics of all the devices and volumes are logged in the same second
+    second = stamp[:19]
+    if second not in SECOND_CACHE:
+        SECOND_CACHE.clear()
+        SECOND_CACHE[second] = calendar.timegm(time.strptime(second.replace('T', ' '),
+                                                             '%Y-%m-%d %H:%M:%S'))
+    return SECOND_CACHE[second] + float(stamp[19:] or 0)
+
+def add_sample(run, metric_type, uuid, direction, line_str, s_list):
+    """Keeps a metrics sample for the I/O rate statistics
+
+       Parameters:
+            run - the run number
+            metric_type - Storage or Volume
+            uuid - the device or volume UUID
+            direction - READ or WRITE
+            line_str - the message
+            s_list - the sample's values, I/O count and bytes first
+    """
+    stamp = log_time(line_str)
+    if stamp is None:
+        return
+    key = (run, metric_type, uuid, direction)
+    if key not in SAMPLES:
+        SAMPLES[key] = (array.array('d'), array.array('d'), array.array('d'))
+    times, ios, nbytes = SAMPLES[key]
+    times.append(stamp)
+    ios.append(float(s_list[0]))
+    nbytes.append(float(s_list[1]))
+
+def sample_rates(times, ios, nbytes):
+    """Yields (time, seconds, I/Os, bytes, IOPS, bytes per second, average I/O size) for
+       each interval between samples. The samples are running totals, one that is lower than
+       the one before it follows a clear of the statistics and is the total since then.
+
+       Parameters:
+            times - the sample times
+            ios - the I/O counts
+            nbytes - the byte counts
+    """
+    for idx in xrange(1, len(times)):
+        secs = times[idx] - times[idx - 1]
+        if secs <= 0:
+            continue
+        d_ios = ios[idx] - ios[idx - 1] if ios[idx] >= ios[idx - 1] else ios[idx]
+        d_bytes = nbytes[idx] - nbytes[idx - 1] if nbytes[idx] >= nbytes[idx - 1] \
+            else nbytes[idx]
+        yield (times[idx], secs, d_ios, d_bytes, d_ios / secs, d_bytes / secs,
+               d_bytes / d_ios if d_ios else 0.0)
+
+def percentiles(values):
+    """Returns the STATS_PERCENTILES and the maximum of values, by the nearest rank method
+    """
+    values = sorted(values)
+    result = [values[max(0, -(-pct * len(values) // 100) - 1)] for pct in STATS_PERCENTILES]
+    return result + [values[-1]]
+
+def print_rate_stats():
+    """Prints a comment with the percentiles of the rates between the metrics samples
+       of each run, device or volume and direction.
+    """
+    print "\n# I/O Rates per Run"
+    print "# Percentiles {} and maximum of the intervals between metrics samples".format(
+        "/".join("p{}".format(pct) for pct in STATS_PERCENTILES))
+    for (run, metric_type, uuid, direction), arrays in SAMPLES.items():
+        rates = list(sample_rates(*arrays))
+        if not rates:
+            continue
+        print "# nuvo_run{} {} {} {}: {} intervals, {:.0f} s".format(
+            run, metric_type, uuid, direction, len(rates), sum(rate[1] for rate in rates))
+        for name, col, scale in [('IOPS', 4, 1), ('MB/s', 5, 1 << 20),
+                                 ('Avg. IO Size', 6, 1)]:
+            print "#  {:>12}: {}".format(name, " ".join(
+                "{:10.1f}".format(val / scale) for val in percentiles(r[col] for r in rates)))
+
+def write_stats_csv(path):
+    """Writes the rates between the metrics samples to a CSV file, one row per interval.
+
+       Parameters:
+            path - the CSV file
+    """
+    with open(path, 'wb') as filep:
+        writer = csv.writer(filep)
+        writer.writerow(STATS_CSV_FIELDS)
+        for (run, metric_type, uuid, direction), arrays in SAMPLES.items():
+            for rate in sample_rates(*arrays):
+                writer.writerow([run, metric_type, uuid, direction,
+                                 '%.6f' % rate[0]] + ['%.3f' % val for val in rate[1:]])
+
+def latency_bucket(usecs):
+    """Returns the histogram bucket of a latency in microseconds
+    """
+    shift = max(0, usecs.bit_length() - LATENCY_SUB_BITS)
+    return (shift << LATENCY_SUB_BITS) + (usecs >> shift)
+
+def bucket_value(bucket):
+    """Returns the latency in microseconds in the middle of a histogram bucket
+    """
+    shift, base = divmod(bucket, 1 << LATENCY_SUB_BITS)
+    return (base << shift) + ((1 << shift) >> 1)
+
+def latency_percentile(entry, pct):
+    """Returns a percentile of the latencies of a LATENCY_STATS entry in microseconds
+
+       Parameters:
+            entry - [histogram, calls, maximum, slow calls]
+            pct - the percentile
+    """
+    histogram, calls, maximum, _ = entry
+    rank = max(1, -(-pct * calls // 100))
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen >= rank:
+            return min(bucket_value(bucket), maximum)
+    return maximum
+
+def merge_latency(stats, key, entry):
+    """Adds a LATENCY_STATS entry to the entry for key in stats
+    """
+    if key not in stats:
+        stats[key] = [{}, 0, 0, 0]
+    kept = stats[key]
+    for bucket, calls in entry[0].items():
+        kept[0][bucket] = kept[0].get(bucket, 0) + calls
+    kept[1] += entry[1]
+    kept[2] = max(kept[2], entry[2])
+    kept[3] += entry[3]
+
+def latency_call(api, match_str, line_str):
+    """Remembers the time of a NUVOAPI call and its command, the last one in COMMANDS,
+       until its completion is found.
+
+       Parameters:
+            api - the api string
+            match_str - the text following the api name
+            line_str - line string
+    """
+    stamp = log_time(line_str)
+    if stamp is not None:
+        PENDING[(api, match_str.split(')', 1)[0])] = (stamp, len(COMMANDS) - 1)
+
+def latency_completion(api, match_str, line_str, run):
+    """Adds the latency of a completed NUVOAPI call to the histogram of its API in the run,
+       and flags the command of a slow call.
+
+       Parameters:
+            api - the api string
+            match_str - the text following the api name
+            line_str - line string
+            run - the current run number
+    """
+    call = PENDING.pop((api, match_str.split(')', 1)[0]), None)
+    stamp = log_time(line_str)
+    if call is None or stamp is None or stamp < call[0]:
+        return
+    usecs = int(round((stamp - call[0]) * 1000000))
+    if (run, api) not in LATENCY_STATS:
+        LATENCY_STATS[(run, api)] = [{}, 0, 0, 0]
+    entry = LATENCY_STATS[(run, api)]
+    bucket = latency_bucket(usecs)
+    entry[0][bucket] = entry[0].get(bucket, 0) + 1
+    entry[1] += 1
+    entry[2] = max(entry[2], usecs)
+    if api in SLOW_APIS and usecs > SLOW_MS * 1000:
+        entry[3] += 1
+        COMMANDS[call[1]] = "\t# Agentd reported the next NUVO API call took " + \
+            "{:.3f} s\n".format(usecs / 1000000.0) + COMMANDS[call[1]]
+
+def print_latency_stats():
+    """Prints a comment with the latency percentiles of each API in each run, and across
+       all runs.
+    """
+    print "\n# NUVOAPI Latency in ms"
+    print "# Calls slower than {} ms are flagged for {}".format(SLOW_MS, ", ".join(SLOW_APIS))
+    header = "#   {:<20} {:>8} {:>10} {:>10} {:>10} {:>6}".format(
+        'API', 'Calls', 'p50', 'p99', 'Max', 'Slow')
+    totals = collections.OrderedDict()
+    run = None
+    for key in LATENCY_STATS:
+        if key[0] != run:
+            run = key[0]
+            print "# nuvo_run{}".format(run) if run >= 0 else "# Before the first startup"
+            print header
+        print_latency_entry(key[1], LATENCY_STATS[key])
+    for key in sorted(LATENCY_STATS, key=lambda key: key[1]):
+        merge_latency(totals, key[1], LATENCY_STATS[key])
+    print "# All runs"
+    print header
+    for api, entry in totals.items():
+        print_latency_entry(api, entry)
+
+def print_latency_entry(api, entry):
+    """Prints the line of print_latency_stats for an API
+    """
+    print "#   {:<20} {:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>6}".format(
+        api, entry[1], latency_percentile(entry, 50) / 1000.0,
+        latency_percentile(entry, 99) / 1000.0, entry[2] / 1000.0, entry[3])
+
 def print_vars():
     """Adds the default environment variables to the script output
     """
@@ -234,23 +1527,62 @@ def print_vars():
     for key, val in DEF_VARS.items():
         print "{}={}".format(key, val)
 
-def print_v_uuids():
-    """Prints the assigned $VOL{#} variable for each volume UUID.
+def print_replay_fns(speed):
+    """Adds the REPLAY_SPEED variable and the function that sleeps between calls
+       to the script
+
+       Parameters:
+            speed - the default REPLAY_SPEED
     """
-    if not SUB_VOLUME_AND_PIT_UUIDS:
-        return
-    print "\n# Volume UUID Substitution"
-    for uuid in V_UUIDS:
-        print "{}=$(uuidgen)".format(V_UUIDS[uuid])
+    print "\n# The time between the calls in the log is divided by REPLAY_SPEED,"
+    print "# 0 replays the calls without sleeping"
+    print "REPLAY_SPEED=${{REPLAY_SPEED:-{:g}}}".format(speed)
+    print "\nreplay_sleep() {"
+    print "\t[ \"$REPLAY_SPEED\" = 0 ] || sleep $(awk \"BEGIN {print ${1} / $REPLAY_SPEED}\")"
+    print "}"
 
-def print_pit_uuids():
-    """Prints the assigned $PIT{#} variable for each PiT UUID.
+def table_lines():
+    """Returns the lines that set the DEV_MAP entries and the $VOL{#} and $PIT{#}
+       variables for each device, volume UUID and PiT UUID.
     """
-    if not SUB_VOLUME_AND_PIT_UUIDS:
-        return
-    print "\n# PiT UUID Substitution"
-    for uuid in PIT_UUIDS:
-        print "{}=$(uuidgen)".format(PIT_UUIDS[uuid])
+    lines = dev_map_lines()
+    if SUB_VOLUME_AND_PIT_UUIDS:
+        lines.append("\n# Volume UUID Substitution")
+        for uuid in V_UUIDS:
+            lines.append("{}=$(uuidgen)".format(V_UUIDS[uuid]))
+        lines.append("\n# PiT UUID Substitution")
+        for uuid in PIT_UUIDS:
+            lines.append("{}=$(uuidgen)".format(PIT_UUIDS[uuid]))
+    return lines
+
+def dev_map_lines():
+    """Returns the lines that set the DEV_MAP entry for each device
+    """
+    return ["# Device Map", "# Substitute device paths for local environment",
+            "declare -A DEV_MAP"] + DEV_DECLS
+
+def print_tables(vars_file):
+    """Prints the substitution variables used by the run functions, or writes them
+       to a file and prints the command that sources it.
+
+       Parameters:
+            vars_file - the file name, or None
+    """
+    if vars_file:
+        with open(vars_file, 'w') as filep:
+            filep.write("\n".join(table_lines()) + "\n")
+        print "\n# Device Map and UUID Substitution"
+        print "source '{}'".format(vars_file)
+    else:
+        print "\n" + "\n".join(table_lines())
+
+def new_var(prefix, uuid, table):
+    """Returns the script variable for a UUID that is not in the table yet
+    """
+    if SEGMENT_UUIDS is None:
+        return '{}{}'.format(prefix, len(table))
+    SEGMENT_UUIDS.append((prefix, uuid))
+    return '\0{}\0{}\0'.format(prefix, uuid)
 
 def pit_sub(uuid):
     """Stores the UUID in a script PIT{#} variable
@@ -261,7 +1593,7 @@ def pit_sub(uuid):
     if uuid in PIT_UUIDS:
         p_var = PIT_UUIDS[uuid]
     else:
-        p_var = 'PIT{}'.format(len(PIT_UUIDS))
+        p_var = new_var('PIT', uuid, PIT_UUIDS)
         PIT_UUIDS[uuid] = p_var
     return '$' + p_var
 
@@ -273,7 +1605,7 @@ def e_name(uuid, name):
     elif uuid in V_UUIDS or uuid in PIT_UUIDS:
         E_NAMES[uuid] = name
     else:
-        print "Parse error"
+        sys.stderr.write("Parse error\n")
     return name
 
 def v_sub(uuid):
@@ -285,10 +1617,30 @@ def v_sub(uuid):
     if uuid in V_UUIDS:
         v_var = V_UUIDS[uuid]
     else:
-        v_var = 'VOL{}'.format(len(V_UUIDS))
+        v_var = new_var('VOL', uuid, V_UUIDS)
         V_UUIDS[uuid] = v_var
     return '$' + v_var
 
+def node_sub(uuid):
+    """Stores the UUID in a script NODE{#} variable
+    """
+    if not MULTI_NODE:
+        return uuid
+
+    if uuid in NODE_UUIDS:
+        n_var = NODE_UUIDS[uuid]
+    else:
+        n_var = new_var('NODE', uuid, NODE_UUIDS)
+        NODE_UUIDS[uuid] = n_var
+    return '$' + n_var
+
+def addr_sub(addr):
+    """Looks up a node address in the NODE_ADDR variable
+    """
+    if not MULTI_NODE:
+        return addr
+    return '${NODE_ADDR[\"' + addr + '\"]}'
+
 def d_sub(d_path):
     """Stores the device path name in the DEV_MAP variable
     """
@@ -299,7 +1651,7 @@ def d_sub(d_path):
         decl_var = 'DEV_MAP[\"' + basename + '\"]=\'' + d_path + '\''
         d_var = '${DEV_MAP[\"' + basename + '\"]}'
         D_DEVICES[basename] = d_var
-        print "{}".format(decl_var)
+        DEV_DECLS.append(decl_var)
     return d_var
 
 def add_mount_cmd(api, v_uuid):
@@ -318,8 +1670,7 @@ def cmd_status_check(status, line_str):
             status - the status string
             line_str - line string
     """
-    regex = re.escape(status)
-    return bool(re.search(regex, line_str))
+    return status in line_str
 
 
 def cmd_status(line_str, api):
@@ -333,8 +1684,7 @@ def cmd_status(line_str, api):
             api - the api string
     """
     if api == 'GetStats':
-        regex = r"\(.*\).(R|W)$"
-        if re.search(regex, line_str):
+        if GET_STATS_CALL_RE.search(line_str):
             return ''
         return 'failed'
     elif cmd_status_check('error', line_str):
@@ -354,8 +1704,7 @@ def get_params(line_str):
             line_str - line string
     """
     params = []
-    regex = r"\(.*\)"
-    match = re.search(regex, line_str)
+    match = PARAMS_RE.search(line_str)
     if match:
         pvars = match.group().split(',')
         num_pvars = len(pvars)
@@ -377,68 +1726,98 @@ def process_line(raw_line_str, startups):
        Parameters:
             line_str - line string
     """
+    # Most lines are not about nuvo at all
+    if API_PREFIX not in raw_line_str and STARTUP_MSG not in raw_line_str:
+        return startups
+
     # Remove \n from strings
-    regex = r"\\n"
-    line_str = re.sub(regex, '', raw_line_str)
+    return process_message(raw_line_str.replace('\\n', ''), startups)
 
-    # This message in the log means agentd gave up on nuvo
-    regex = r"NUVOAPI NOT INITIALIZED"
-    match = re.search(regex, line_str)
-    if match:
+def process_json_line(raw_line_str, startups):
+    """Takes a line from the agentd-json.log file and searches its message for a nuvo
+       api command. Only the lines that can contain one are decoded.
+
+       Parameters:
+            line_str - line string
+    """
+    if API_PREFIX not in raw_line_str and STARTUP_MSG not in raw_line_str:
+        return startups
+    # Docker writes the log field first. Without escapes other than \n it needs no decoding.
+    if raw_line_str.startswith(JSON_LOG_START):
+        end = raw_line_str.rfind(JSON_LOG_END)
+        if end > 0:
+            message = raw_line_str[len(JSON_LOG_START):end].replace('\\n', '')
+            if '\\' not in message:
+                return process_message(message, startups)
+    try:
+        message = json.loads(raw_line_str)['log']
+    except (ValueError, KeyError, TypeError):
+        return process_line(raw_line_str, startups)
+    return process_message(message.encode('utf-8').replace('\n', ''), startups)
+
+def process_message(line_str, startups):
+    """Processes a log message that may be about nuvo.
+
+       Parameters:
+            line_str - the message
+            startups - the number of startups so far
+    """
+    if NOT_INITIALIZED_MSG in line_str:
         msg = "\t# Agentd reported that the nuvo process was no longer responding."
-        COMMANDS.append(msg)
+        add_command(msg)
         return startups
 
     # UseNodeUUID can be called several times before succeeding.
     # We only care about the successful attempt. Discard others.
-    regex = r"Successfully set nuvo service node UUID.*"
-    match = re.search(regex, line_str)
+    match = STARTUP_RE.search(line_str)
     if match:
         if startups > 0:
             # End the previous run function
-            cmd = "\tset +ex\n\techo 'End of nuvo_vm commands'\n"
-            cmd += "}} # End nuvo_run{}()\n".format(startups - 1)
-            COMMANDS.append(cmd)
+            add_command(end_run_cmd('nuvo_run{}'.format(startups - 1)))
             msg = "# Restart {}\n".format(startups)
         else:
             msg = "\n# Initial Startup\n"
+        # The previous run, or the commands before the first startup, are complete
+        print_commands()
+        # The calls in progress were lost with the nuvo process
+        PENDING.clear()
 
         # Start a new run function
         cmd = msg + "nuvo_run{}() {{\n".format(startups)
         cmd += "\tset -ex"
         startups += 1
-        COMMANDS.append(cmd)
+        add_command(cmd)
 
+        stamp = log_time(line_str) if REPLAY else None
+        call_line = line_str
         line_str = match.group()
-        regex = r"\[.*\]"
-        match = re.search(regex, line_str)
+        match = NODE_UUID_RE.search(line_str)
         n_uuid = (match.group()).strip('[').strip(']')
-        cmd = "\t" + NUVO_CMD + "use-node-uuid -u " + n_uuid
-        COMMANDS.append(cmd)
+        cmd = "\t" + NUVO_CMD + "use-node-uuid -u " + node_sub(n_uuid)
+        call = None
+        if CALL_FILE or MULTI_NODE:
+            call = call_record(startups - 1, call_line, 'UseNodeUUID', {'node-uuid': n_uuid}, None)
+        add_command(cmd, stamp, None, call)
         return startups
 
-    if process_metrics('Storage', line_str):
-        return startups
-    if process_metrics('Volume', line_str):
+    if process_metrics(line_str, startups - 1):
         return startups
-    process_nuvo_api_command(line_str)
+    process_nuvo_api_command(line_str, startups - 1)
     return startups
 
-def process_metrics(metric_type, line_str):
+def process_metrics(line_str, run):
     """Handle Storage and Volume metrics
 
        Parameters:
-            metric_type - the metric type
             line_str - line string
+            run - the current run number
     """
-    if metric_type == 'Storage':
-        regex = r"NUVOAPI Metrics on Storage.*"
-    else:
-        regex = r"NUVOAPI Metrics on Volume.*"
-    match = re.search(regex, line_str)
+    match = METRICS_RE.search(line_str)
     if match:
+        metric_type = match.group(1)
         uuid = (match.group()).split(metric_type)[1].strip().split(' ', 1)[0].strip()
         if (match.group()).find('WRITE') != -1:
+            direction = 'WRITE'
             s_list = ((match.group()).split('{', 1)[1].strip()).split(' ', 5)
             del s_list[4:]
             if metric_type == 'Storage':
@@ -446,12 +1825,17 @@ def process_metrics(metric_type, line_str):
             else:
                 V_WR_STATS[uuid] = s_list
         elif (match.group()).find('READ') != -1:
+            direction = 'READ'
             s_list = ((match.group()).split('{', 1)[1].strip()).split(' ', 5)
             del s_list[4:]
             if metric_type == 'Storage':
                 D_RD_STATS[uuid] = s_list
             else:
                 V_RD_STATS[uuid] = s_list
+        else:
+            return True
+        if KEEP_SAMPLES:
+            add_sample(run, metric_type, uuid, direction, line_str, s_list)
         return True
     return False
 
@@ -477,29 +1861,12 @@ def process_get_stats(api, p_list):
         if p_list[2] == 'true':
             cmd += ' --clear '
     else: # GetVolumeStats or GetVolumeManifest
-        print "api: {} p_list: {}".format(api, p_list)
+        sys.stderr.write("api: {} p_list: {}\n".format(api, p_list))
         cmd += ' --volume-uuid ' + v_sub(p_list[1])
         if p_list[0] == 'true':
             cmd += ' --clear '
     return cmd
 
-def process_arg_value(arg, val):
-    """Processes an individual argument and value
-       Parameters:
-            arg - the argument being processed
-            val - the parameter value
-    """
-    cmd = arg
-    if re.search(r"--vol.*-(uuid|series)", arg):
-        cmd += v_sub(val)
-    elif re.search(r"--(pit|pit-uuid)", arg):
-        cmd += pit_sub(val)
-    elif arg == ' --device ':
-        cmd += d_sub(val)
-    else:
-        cmd += val
-    return cmd
-
 def process_export_lun(api, p_list):
     """Processes the ExportLun and UnExportLun API call
 
@@ -509,22 +1876,20 @@ def process_export_lun(api, p_list):
     """
     cmd = ''
     api_def = API_DICT[api]
+    v_idx = api_def['volume']
     is_pit = False
-    idx = 0
-    for arg in api_def['params']:
-        if arg == ' --vol-series ':
-            v_idx = idx
-            cmd += arg + v_sub(p_list[v_idx])
-        elif arg == ' --pit ':
+    for idx, arg, param_type, _ in api_def['args']:
+        if param_type == 'volume':
+            cmd += arg + v_sub(p_list[idx])
+        elif param_type == 'pit':
             if p_list[idx]:
                 is_pit = True
                 cmd += arg + pit_sub(p_list[idx])
-        elif arg == ' --export-name ':
+        elif param_type == 'export-name':
             cmd += arg + e_name(p_list[v_idx], p_list[idx])
-        elif arg == ' --readonly ':
+        elif param_type == 'readonly':
             if p_list[idx] == 'false':
                 cmd += arg
-        idx += 1
     if not is_pit:
         cmd += add_mount_cmd(api, p_list[v_idx])
     return cmd
@@ -537,87 +1902,121 @@ def process_api_params(api, p_list):
             api - the api being processed
             p_list - the parameter list
     """
-    cmd = ''
     api_def = API_DICT[api]
-    if (api == 'ExportLun' or api == 'UnexportLun'):
-        cmd += process_export_lun(api, p_list)
-    else:
-        for arg in api_def['params']:
-            idx = api_def['params'].index(arg)
-            if arg == ' --readonly ' and p_list[idx] == 'false':
-                cmd += arg
-            elif idx < len(p_list) and p_list[idx]:
-                cmd += process_arg_value(arg, p_list[idx])
-
+    if api_def['handler'] == 'export':
+        return process_export_lun(api, p_list)
+    cmd = ''
+    for idx, arg, _, sub in api_def['args'][:len(p_list)]:
+        if p_list[idx]:
+            cmd += arg + (sub(p_list[idx]) if sub else p_list[idx])
     return cmd
 
 def process_error_msg(line_str):
     """Gets the error message from the log line
     """
-    print "line: {}".format(line_str)
+    sys.stderr.write("line: {}\n".format(line_str.rstrip("\n")))
     msg = ''
-    regex = r"(failed:|error:).*"
-    match = re.search(regex, line_str)
+    match = ERROR_MSG_RE.search(line_str)
     if match:
         msg = (match.group()).split(":", 1)[1]
     else:
         #nuvoapi.apiError
-        regex = r"(What:).*"
-        match = re.search(regex, line_str)
+        match = API_ERROR_RE.search(line_str)
         if match:
             msg = (match.group()).split(",", 2)[1]
     return msg
 
-def process_nuvo_api_command(line_str):
+def find_api(line_str):
+    """Finds the first NUVOAPI entry for an API in API_DICT with a single scan of the line.
+       Returns (api, text following the API name up to any repeat of the name),
+       or (None, None) if there is no such entry.
+
+       Parameters:
+            line_str - line string
+    """
+    for match in API_CALL_RE.finditer(line_str):
+        api = match.group(1)
+        if api not in API_DICT:
+            continue
+        rest = line_str[match.end():]
+        if rest.endswith('\n'):
+            rest = rest[:-1]
+        if API_IGNORE in rest:
+            continue
+        return api, rest.split(api, 1)[0]
+    return None, None
+
+def call_volume(api, p_list):
+    """Returns the UUID of the volume a call is for, or None
+
+       Parameters:
+            api - the api string
+            p_list - the parameter list
+    """
+    idx = API_DICT[api]['volume']
+    if idx is not None and idx < len(p_list) and p_list[idx]:
+        return p_list[idx]
+    return None
+
+def process_nuvo_api_command(line_str, run):
     """A NUVOAPI entry in agentd.log is generally in the following form:
        NUVOAPI ApiName(param1, param2, ...)
-       This compares each line for an NUVOAPI command entry.
-       If it matches, looks up the command line syntax in the API_DICT
+       This finds the NUVOAPI command entry in each line.
+       If there is one, looks up the command line syntax in the API_DICT
        Constructs a nuvo_vm command line with parameters substituted.
        Optional entries are indicated by omission in the agentd.log entry.
 
        Parameters:
             line_str - line string
+            run - the current run number
     """
-    for api in API_DICT:
-        api_str = "NUVOAPI " + api
-        regex = re.escape(api_str) + r".((?!volumeSeriesRequestState).)*$"
-        match = re.search(regex, line_str)
-        if match:
-            cmd = '\t'
-            match_str = (match.group()).split(api)[1]
-            status = cmd_status(match_str, api)
-            if status == '':
-                p_list = get_params(match_str)
-                api_def = API_DICT[api]
-                cmd += NUVO_CMD + api_def['cmd']
-                if api == 'GetStats' or api == 'GetVolumeStats' or api == 'GetVolumeManifest':
-                    regex = r"(for.(read|write))"
-                    if not SUPPRESS_STATS and not re.search(regex, line_str):
-                        cmd += process_get_stats(api, p_list)
-                    else:
-                        return
-                else:
-                    cmd += process_api_params(api, p_list)
-            elif status == 'failed':
-                if api == 'GetStats':
-                    return
-                msg = process_error_msg(line_str)
-                last_cmd = COMMANDS.pop()
-                cmd += "# Agentd reported the next NUVO API call failed. Message: " \
-                    + msg + "\n" + last_cmd
-            elif status == 'succeeded':
-                if api == 'UseCacheDevice':
-                    # On success UseCacheDevice returns the amount of cache capacity added.
-                    regex = r"usableSizeBytes:.*\ "
-                    match = re.search(regex, line_str)
-                    if match:
-                        match_str = (match.group()).split('usableSizeBytes:')[1].strip()
-                        last_cmd = COMMANDS.pop()
-                        cmd += "# Cache device usable size: " + match_str + "\n" + last_cmd
-
-            COMMANDS.append(cmd)
+    api, match_str = find_api(line_str)
+    if not api:
+        return
+    cmd = '\t'
+    # A completion goes with the call before it
+    stamp, volume, call = None, False, None
+    status = cmd_status(match_str, api)
+    if LATENCY and status and api != 'GetStats':
+        latency_completion(api, match_str, line_str, run)
+    if status == '':
+        p_list = get_params(match_str)
+        api_def = API_DICT[api]
+        cmd += NUVO_CMD + api_def['cmd']
+        if api_def['handler'] == 'stats':
+            if not SUPPRESS_STATS and not STATS_FOR_RE.search(line_str):
+                cmd += process_get_stats(api, p_list)
+            else:
+                return
+        else:
+            cmd += process_api_params(api, p_list)
+        stamp = log_time(line_str) if REPLAY else None
+        volume = call_volume(api, p_list) if CONCURRENT else None
+        if CALL_FILE or MULTI_NODE:
+            call = call_record(run, line_str, api,
+                               collections.OrderedDict(zip(api_def['names'], p_list)),
+                               call_volume(api, p_list))
+    elif status == 'failed':
+        if api == 'GetStats':
             return
+        msg = process_error_msg(line_str)
+        last_cmd, stamp, volume, call = pop_command()
+        if call:
+            call['failed'] = msg.strip()
+        cmd += "# Agentd reported the next NUVO API call failed. Message: " \
+            + msg + "\n" + last_cmd
+    elif status == 'succeeded':
+        if api == 'UseCacheDevice':
+            # On success UseCacheDevice returns the amount of cache capacity added.
+            match = USABLE_SIZE_RE.search(line_str)
+            if match:
+                match_str = (match.group()).split('usableSizeBytes:')[1].strip()
+                last_cmd, stamp, volume, call = pop_command()
+                cmd += "# Cache device usable size: " + match_str + "\n" + last_cmd
+
+    add_command(cmd, stamp, volume, call)
+    if LATENCY and status == '':
+        latency_call(api, match_str, line_str)
 
 if __name__ == '__main__':
     main()
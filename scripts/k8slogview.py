@@ -14,22 +14,1495 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 """
-Usage: k8slogview.py [files...]
+Usage: k8slogview.py [--format {auto,docker,cri}] [--decoder {fast,json}] [--benchmark]
+                     [files...]
+
+Reads log files in the docker JSON log file format or the CRI format written by containerd and
+outputs the messages the same way that `kubectl logs` does. Reads stdin if no files are specified.
 
 See the README.md for more information.
 """
 
-import codecs
-import fileinput
+import argparse
+import array
+import bisect
+import bz2
+import calendar
+import collections
+import ctypes
+import ctypes.util
+import datetime
+import distutils.spawn
+import errno
+import gzip
+import heapq
+import io
+import itertools
 import json
+import mmap
+import multiprocessing
+import os
+import re
+import select
+import signal
+import struct
+import subprocess
 import sys
+import time
 
-if __name__ == '__main__':
-    # Force UTF-8 encoded output, needed at least for a pipe
-    sys.stdout = codecs.getwriter('UTF-8')(sys.stdout)
-    for line in fileinput.input():
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None  # --output parquet is not available
+
+# docker writes the fields of each record in this order, see jsonfilelog in moby
+LOG_PREFIX = '{"log":"'
+STREAM_SEP = '","stream":"'
+TIME_SEP = '","time":"'
+
+# containerd and cri-o write "<time> <stream> <tag> <message>" lines, and split long messages
+# into lines tagged P, for partial, followed by a last line tagged F
+CRI_PARTIAL = 'P'
+# a stream is expected within this many characters of the start of a CRI line
+CRI_STREAM_SPAN = 64
+
+# one JSON escape sequence, \uXXXX or a backslash followed by a single character
+ESCAPE_RE = re.compile(r'\\(u[0-9a-fA-F]{4}|.?)', re.S)
+ESCAPES = {
+    '"': '"',
+    '\\': '\\',
+    '/': '/',
+    'b': '\b',
+    'f': '\f',
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+}
+
+# an RFC3339 timestamp, as written by docker and containerd
+TIME_RE = re.compile(r'(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:\d\d)$')
+TIME_FMT = '%Y-%m-%dT%H:%M:%S'
+# the leading fields of a --since or --until argument
+TIME_ARG_FIELDS = ['0000', '-01', '-01', 'T00', ':00', ':00']
+
+# rotated log file names end in .N, optionally followed by a compression suffix
+ROTATION_RE = re.compile(r'(\.\d+)?(\.(gz|bz2|xz|zst))?$')
+# log file names that carry no information beyond the directory they are stored in
+CONTAINER_LOG_RE = re.compile(r'^([0-9a-f]{64}-json|\d+)\.log$')
+
+# compression formats recognized by their magic bytes:
+# (name, magic, decompressor command, in-process fallback or None)
+COMPRESSION = [
+    ('gzip', '\x1f\x8b', ['gzip', '-dc'], gzip.GzipFile),
+    ('bzip2', 'BZh', ['bzip2', '-dc'], bz2.BZ2File),
+    ('xz', '\xfd7zXZ\x00', ['xz', '-dc'], None),
+    ('zstd', '\x28\xb5\x2f\xfd', ['zstd', '-dcq'], None),
+]
+MAGIC_LEN = max(len(magic) for _, magic, _, _ in COMPRESSION)
+
+# sidecar index files, see LogIndex
+INDEX_MAGIC = 'K8SLOGIX'
+INDEX_VERSION = 1
+# magic, version, file size, file mtime, interval, lines, samples
+INDEX_HEADER = struct.Struct('<8sIQdIQQ')
+INDEX_INTERVAL = 1000
+# 64 bit array type code, 'q' is not available before python 3.3
+INT64 = 'l' if array.array('l').itemsize == 8 else 'q'
+# the stream bits of the sidecar index, records of any other stream set all of them
+STREAM_BITS = {'stdout': 1, 'stderr': 2}
+ALL_STREAMS = 3
+
+# the options that select, decode and format records, see select_opts
+DEFAULT_OPTS = {
+    'format': 'auto',
+    'decoder': 'fast',
+    'since': None,
+    'until': None,
+    'stream': None,
+    'lines': None,
+    'level': None,
+    'regexp': None,
+    'ignore_case': False,
+    'output': 'text',
+}
+
+# log levels from least to most severe, with the spellings used by agentd, nuvo and go-logging
+LEVELS = ['DEBUG', 'INFO', 'NOTICE', 'WARNING', 'ERROR', 'CRITICAL']
+LEVEL_NAMES = {
+    'TRACE': 0, 'DEBUG': 0, 'DEBU': 0,
+    'INFO': 1,
+    'NOTICE': 2, 'NOTI': 2,
+    'WARNING': 3, 'WARN': 3,
+    'ERROR': 4, 'ERRO': 4, 'ERR': 4,
+    'CRITICAL': 5, 'CRIT': 5, 'FATAL': 5, 'PANIC': 5,
+}
+LEVEL_RE = re.compile(r'\b(%s)\b' % '|'.join(sorted(LEVEL_NAMES, key=len, reverse=True)))
+# the level is looked for in this many leading characters of a message
+LEVEL_SPAN = 80
+# the timestamp, level and module that start agentd and nuvo messages, eg
+# 2019-02-01 10:00:00.123456Z INFO nuvoapi NUVOAPI UseDevice(...)
+MESSAGE_RE = re.compile(
+    r'(\d{4}-\d\d-\d\d[T ]\d\d:\d\d:\d\d(?:[.,]\d+)?(?:Z|[+-]\d\d:?\d\d)?) +\[?(%s)\]? +'
+    r'(\S+?):? +(.*)' % '|'.join(sorted(LEVEL_NAMES, key=len, reverse=True)), re.S)
+# the fields of a record in --output json and parquet
+RECORD_FIELDS = ['time', 'stream', 'source', 'timestamp', 'level', 'module', 'message']
+# records in each row group of a Parquet file
+PARQUET_ROWS = 64 * 1024
+# characters that can start a special sequence in a regular expression
+REGEXP_SPECIAL = set('.^$*+?{}[]\\|()')
+# characters that are written unchanged in a JSON string by any encoder
+JSON_SAFE = set(chr(c) for c in range(0x20, 0x7f)) - set('"\\/<>&')
+
+# inotify events on the directories of followed files that may mean there is more to read
+IN_MODIFY = 0x2
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+# seconds between checks of followed files when inotify is not available, or its events missed
+FOLLOW_POLL_SEC = 0.25
+FOLLOW_INOTIFY_SEC = 1.0
+
+# bytes of output collected before they are written to stdout
+OUTPUT_BUFFER = 64 * 1024
+
+# default size of the byte ranges of a file that are decoded in parallel by --jobs
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# lines that exercise the corners of decode_fast, checked against json.loads by --benchmark
+SELF_TEST_CORPUS = [
+    '{"log":"plain message\\n","stream":"stdout","time":"2019-02-01T10:00:00.123456789Z"}\n',
+    '{"log":"no newline","stream":"stderr","time":"2019-02-01T10:00:00.1Z"}\n',
+    '{"log":"\\n","stream":"stdout","time":"2019-02-01T10:00:00Z"}\n',
+    '{"log":"","stream":"stdout","time":"2019-02-01T10:00:00Z"}',
+    '{"log":"quoted \\"value\\", and \\\\ backslash\\n","stream":"stdout",'
+    '"time":"2019-02-01T10:00:00.5Z"}\n',
+    '{"log":"looks like a field \\",\\"stream\\":\\"stderr\\n","stream":"stdout",'
+    '"time":"2019-02-01T10:00:00.5Z"}\n',
+    '{"log":"ends in backslash \\\\","stream":"stdout","time":"2019-02-01T10:00:00.5Z"}\n',
+    '{"log":"tab\\there\\r\\n","stream":"stdout","time":"2019-02-01T10:00:00.5Z"}\n',
+    '{"log":"html \\u003cb\\u003e \\u0026 \\u2028","stream":"stdout",'
+    '"time":"2019-02-01T10:00:00.5Z"}\n',
+    '{"log":"raw utf-8 \xc3\xa9\xe2\x82\xac\\n","stream":"stdout",'
+    '"time":"2019-02-01T10:00:00.5Z"}\n',
+    '{"log":"surrogate pair \\ud83d\\ude00\\n","stream":"stdout",'
+    '"time":"2019-02-01T10:00:00.5Z"}\n',
+    '{"log":"control \\u0000\\b\\f\\/","stream":"stdout","time":"2019-02-01T10:00:00.5Z"}\n',
+    '{"log":"extra attrs\\n","stream":"stdout","attrs":{"tag":"x"},'
+    '"time":"2019-02-01T10:00:00.5Z"}\n',
+    '{"stream":"stdout","log":"reordered\\n","time":"2019-02-01T10:00:00.5Z"}\n',
+    '{ "log" : "spaced\\n", "stream" : "stdout", "time" : "2019-02-01T10:00:00.5Z" }\n',
+]
+
+
+def unescape_one(match):
+    """Returns the replacement for one JSON escape sequence matched by ESCAPE_RE.
+    Raises ValueError for anything decode_fast should leave to json.loads.
+    """
+    esc = match.group(1)
+    if len(esc) == 5:
+        code = int(esc[1:], 16)
+        if 0xd800 <= code < 0xe000:
+            raise ValueError('surrogate escape')
+        return unichr(code).encode('UTF-8')
+    return ESCAPES[esc]
+
+
+def unescape(log):
+    """Returns the JSON string body log with its escape sequences replaced.
+    Raises ValueError or KeyError for anything decode_fast should leave to json.loads.
+    """
+    if '\\u' in log or '\\/' in log:
+        return ESCAPE_RE.sub(unescape_one, log)
+    # The other JSON escapes mean the same in python string literals
+    return log.decode('string_escape')
+
+
+def decode_fast(line):
+    """Decodes one docker JSON log record without a full JSON parse.
+    Returns (log, stream, time), or None if the line is not in the exact layout docker writes
+    and must be handed to json.loads instead. The log is returned as the UTF-8 bytes in the
+    line, it is not decoded.
+    """
+    if not line.startswith(LOG_PREFIX):
+        return None
+    # The log value cannot contain an unescaped '"', so the first separator ends it.
+    end = line.find(STREAM_SEP, 8)
+    if end < 0:
+        return None
+    stream_end = line.find(TIME_SEP, end + 12)
+    if stream_end < 0:
+        return None
+    time_end = line.find('"', stream_end + 10)
+    if time_end < 0 or line[time_end + 1:].rstrip('\r\n') != '}':
+        return None
+    log = line[8:end]
+    if '\\' in log:
+        if log.endswith('\\n') and log.count('\\') == 1:
+            log = log[:-2] + '\n'
+        else:
+            try:
+                log = unescape(log)
+            except (KeyError, ValueError):
+                return None
+    return log, line[end + 12:stream_end], line[stream_end + 10:time_end]
+
+
+def decode_json(line):
+    """Decodes one docker JSON log record with json.loads.
+    Returns (log, stream, time) with log UTF-8 encoded. Docker ends every record with a
+    newline, so a line without one that is not valid JSON was cut short, at the end of a file
+    that was rotated or is still being written, and it is returned as the log, with no stream
+    or time.
+    """
+    try:
         obj = json.loads(line)
+    except ValueError:
+        if line.endswith('\n'):
+            raise
+        return line, '', ''
+    return obj['log'].encode('UTF-8'), obj.get('stream', ''), obj.get('time', '')
+
+
+def decode_line(line):
+    """Decodes one docker JSON log record, using json.loads only when decode_fast cannot.
+    """
+    rec = decode_fast(line)
+    if rec is None:
+        return decode_json(line)
+    return rec
+
+
+DECODERS = {
+    'fast': decode_line,
+    'json': decode_json,
+}
+
+
+class DockerParser(object):
+    """Parses the docker JSON log file format, one JSON record per line.
+    """
+    partial_lines = False
+
+    def __init__(self, decoder='fast'):
+        self.decode = DECODERS[decoder]
+
+    @staticmethod
+    def detect(line):
+        """Returns True if the line is in this format"""
+        return line.lstrip().startswith('{')
+
+    def line_info(self, line):
+        """Returns the (stream, time) of one line"""
+        _, stream, stamp = self.decode(line)
+        return stream, stamp
+
+    @staticmethod
+    def is_partial(line):
+        """Returns True if the line is followed by more of the same record"""
+        return False
+
+    @staticmethod
+    def stream_check(stream):
+        """Returns a function that cheaply rejects lines of another stream"""
+        marker = STREAM_SEP + stream + TIME_SEP
+        return lambda line: marker in line or not line.startswith(LOG_PREFIX)
+
+    def records(self, lines, prefilter=None, final=True):
+        """Yields the (log, stream, time) record of each line that passes prefilter.
+        """
+        decode = self.decode
+        if not prefilter:
+            for line in lines:
+                yield decode(line)
+            return
+        for line in lines:
+            if prefilter(line):
+                yield decode(line)
+
+
+class CriParser(object):
+    """Parses the CRI log file format written by containerd and cri-o, and joins the partial
+    lines of long messages into one record. The fields are found with str.find, only the
+    message is copied out of the line.
+    A parser is used for one file at a time, as it holds the partial lines of each stream.
+    """
+    partial_lines = True
+
+    def __init__(self, _decoder=None):
+        self.pending = {}  # stream: (time, [messages of the partial lines])
+
+    @staticmethod
+    def split(line):
+        """Returns the offsets of the spaces after the time, stream and tag of a line"""
+        time_end = line.find(' ')
+        stream_end = line.find(' ', time_end + 1)
+        tag_end = line.find(' ', stream_end + 1)
+        if time_end <= 0 or stream_end < 0:
+            raise ValueError('not a CRI log line: %r' % line[:100])
+        if tag_end < 0:  # an empty message, with the trailing space stripped
+            tag_end = len(line.rstrip('\r\n'))
+        return time_end, stream_end, tag_end
+
+    @staticmethod
+    def detect(line):
+        """Returns True if the line is in this format"""
+        fields = line.split(' ', 3)
+        return len(fields) >= 3 and bool(TIME_RE.match(fields[0]))
+
+    def line_info(self, line):
+        """Returns the (stream, time) of one line"""
+        time_end, stream_end, _ = self.split(line)
+        return line[time_end + 1:stream_end], line[:time_end]
+
+    def is_partial(self, line):
+        """Returns True if the line is followed by more of the same record"""
+        _, stream_end, tag_end = self.split(line)
+        return line[stream_end + 1:tag_end] == CRI_PARTIAL
+
+    @staticmethod
+    def stream_check(stream):
+        """Returns a function that cheaply rejects lines of another stream"""
+        marker = ' %s ' % stream
+        return lambda line: marker in line[:CRI_STREAM_SPAN]
+
+    def records(self, lines, prefilter=None, final=True):
+        """Yields the (log, stream, time) record of each complete message. The time of a
+        message that was split is the time of its first line.
+        Lines that do not pass prefilter are skipped, unless they complete a message, which
+        the lines seen so far may match. If final is False the partial lines of incomplete
+        messages are kept for the next call, otherwise they are yielded at the end.
+        """
+        pending = self.pending
+        split = self.split
+        for line in lines:
+            time_end, stream_end, tag_end = split(line)
+            stream = line[time_end + 1:stream_end]
+            if line[stream_end + 1:tag_end] == CRI_PARTIAL:
+                msg = line[tag_end + 1:].rstrip('\r\n')
+                if stream in pending:
+                    pending[stream][1].append(msg)
+                else:
+                    pending[stream] = (line[:time_end], [msg])
+                continue
+            if stream in pending:
+                stamp, parts = pending.pop(stream)
+                parts.append(line[tag_end + 1:])
+                yield ''.join(parts), stream, stamp
+            elif not prefilter or prefilter(line):
+                yield line[tag_end + 1:], stream, line[:time_end]
+        if final:
+            for stream, (stamp, parts) in sorted(pending.items()):
+                yield ''.join(parts), stream, stamp
+            pending.clear()
+
+
+# log file formats, in the order they are detected
+PARSERS = collections.OrderedDict([
+    ('docker', DockerParser),
+    ('cri', CriParser),
+])
+
+
+def detect_parser(line, opts):
+    """Returns a parser for the format in opts, or for the format of the first line of a file
+    if the format is auto. Files that are empty or in no known format are parsed as docker.
+    """
+    name = opts['format']
+    if name == 'auto':
+        name = next((name for name, cls in PARSERS.items() if cls.detect(line)), 'docker')
+    return PARSERS[name](opts['decoder'])
+
+
+class DecompressedFile(object):
+    """Reads the output of a decompressor process as a file.
+    Decompression runs in the child process, concurrently with decoding in this one.
+    """
+
+    def __init__(self, cmd, path):
+        self.cmd = cmd
+        self.proc = subprocess.Popen(cmd + [path], stdout=subprocess.PIPE, bufsize=-1)
+        self.stdout = self.proc.stdout
+
+    def __iter__(self):
+        # file iteration reads ahead, which would prevent the read in close
+        return iter(self.stdout.readline, '')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, size=-1):
+        """Reads up to size bytes, or to the end if size is negative"""
+        return self.stdout.read(size)
+
+    def readline(self):
+        """Reads the next line"""
+        return self.stdout.readline()
+
+    def close(self):
+        """Closes the pipe and waits for the decompressor.
+        If the output was not read to the end the decompressor is no longer needed and is
+        terminated, otherwise it must have succeeded.
+        """
+        if self.stdout.read(1):
+            self.proc.terminate()
+            self.stdout.close()
+            self.proc.wait()
+            return
+        self.stdout.close()
+        if self.proc.wait() > 0:
+            raise IOError('%s failed' % ' '.join(self.cmd))
+
+
+def compression(path):
+    """Returns the COMPRESSION entry matching the magic bytes of the file, or None.
+    """
+    with open(path, 'rb') as filep:
+        head = filep.read(MAGIC_LEN)
+    for entry in COMPRESSION:
+        if head.startswith(entry[1]):
+            return entry
+    return None
+
+
+def open_log(path):
+    """Opens a log file for reading, decompressing it as a stream if it is compressed.
+    An external decompressor is preferred, so decompression overlaps with decoding.
+    """
+    entry = compression(path)
+    if not entry:
+        return open(path, 'rb')
+    name, _, cmd, fallback = entry
+    if distutils.spawn.find_executable(cmd[0]):
+        return DecompressedFile(cmd, path)
+    if fallback:
+        return fallback(path, 'rb')
+    raise IOError('%s: %s is needed to read %s compressed files' % (path, cmd[0], name))
+
+
+def file_parser(path, opts):
+    """Returns a parser for the format of a log file, see detect_parser.
+    """
+    line = ''
+    if opts['format'] == 'auto':
+        with open_log(path) as filep:
+            line = next(iter(filep), '')
+    return detect_parser(line, opts)
+
+
+def find_time(mem, key, start, end, parser):
+    """Binary searches the lines of mem between the line boundaries start and end.
+    Returns the offset of the first line with a record time at or after key, or end if there
+    is none. The record times must not decrease, as they do not in a log file.
+    """
+    while start < end:
+        mid = (start + end) // 2
+        # probe the first line that starts in [mid, end), or the line at start if there is none
+        probe = mem.find('\n', mid - 1, end) + 1 if mid > start else start
+        if probe <= start or probe >= end:
+            probe = start
+        line_end = mem.find('\n', probe, end)
+        line_end = end if line_end < 0 else line_end + 1
+        if time_key(parser.line_info(mem[probe:line_end])[1]) < key:
+            start = line_end
+        else:
+            end = probe
+    return end
+
+
+def byte_range(path, since, until, parser):
+    """Returns the (start, end) offsets of the lines of an uncompressed log file with record
+    times in [since, until), found by binary searching the memory-mapped file.
+    """
+    size = os.path.getsize(path)
+    if not size or (since is None and until is None):
+        return 0, size
+    with open(path, 'rb') as filep:
+        mem = mmap.mmap(filep.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        start = find_time(mem, since, 0, size, parser) if since is not None else 0
+        end = find_time(mem, until, start, size, parser) if until is not None else size
+    finally:
+        mem.close()
+    return start, end
+
+
+class LogIndex(object):
+    """A sidecar index of an uncompressed log file, stored in a hidden file next to it.
+    The byte offset and record time of every interval'th line are sampled, and the streams of
+    the records in each block of interval lines are kept as a bit mask.
+    The index is only used while the size and modification time of the log file are unchanged.
+    """
+
+    def __init__(self, size, mtime, interval):
+        self.size = size
+        self.mtime = mtime
+        self.interval = interval
+        self.lines = 0
+        self.offsets = array.array(INT64)
+        self.times = array.array(INT64)  # nanoseconds since the epoch
+        self.streams = array.array('B')
+
+    @staticmethod
+    def path(log_path):
+        """Returns the path of the index of a log file.
+        The name is hidden so that the index does not match a *json.log* wildcard.
+        """
+        head, tail = os.path.split(log_path)
+        return os.path.join(head, '.%s.idx' % tail)
+
+    @classmethod
+    def build(cls, log_path, parser, interval=INDEX_INTERVAL):
+        """Scans a log file and returns its index.
+        """
+        stat = os.stat(log_path)
+        index = cls(stat.st_size, stat.st_mtime, interval)
+        offset = 0
+        last_ns = 0
+        mask = 0
+        with open(log_path, 'rb') as filep:
+            for line in filep:
+                stream, stamp = parser.line_info(line)
+                if not index.lines % interval:
+                    if index.lines:
+                        index.streams.append(mask)
+                    mask = 0
+                    # keep the samples in order for bisect, even if the clock went back
+                    last_ns = max(key_ns(time_key(stamp)), last_ns)
+                    index.offsets.append(offset)
+                    index.times.append(last_ns)
+                mask |= STREAM_BITS.get(stream, ALL_STREAMS)
+                index.lines += 1
+                offset += len(line)
+                if offset >= index.size:  # the file is growing, index what was there
+                    break
+        if index.offsets:
+            index.streams.append(mask)
+        return index
+
+    @classmethod
+    def load(cls, log_path):
+        """Returns the index of a log file, or None if it has none or it is out of date.
+        """
         try:
-            print obj['log'].rstrip("\n\r")
-        except IOError:  # eg when stdout is a pipe that closes
-            sys.exit(0)
+            with open(cls.path(log_path), 'rb') as filep:
+                magic, version, size, mtime, interval, lines, count = INDEX_HEADER.unpack(
+                    filep.read(INDEX_HEADER.size))
+                if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                    return None
+                stat = os.stat(log_path)
+                if size != stat.st_size or mtime != stat.st_mtime:
+                    sys.stderr.write('ignoring the out of date index of %s, use --build-index '
+                                     'to rebuild it\n' % log_path)
+                    return None
+                index = cls(size, mtime, interval)
+                index.lines = lines
+                index.offsets.fromfile(filep, count)
+                index.times.fromfile(filep, count)
+                index.streams.fromfile(filep, count)
+        except (IOError, OSError, EOFError, struct.error):
+            return None
+        return index
+
+    def save(self, log_path):
+        """Writes the index next to the log file.
+        """
+        with open(self.path(log_path), 'wb') as filep:
+            filep.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, self.size, self.mtime,
+                                          self.interval, self.lines, len(self.offsets)))
+            self.offsets.tofile(filep)
+            self.times.tofile(filep)
+            self.streams.tofile(filep)
+
+    def ranges(self, opts):
+        """Returns the byte ranges of the blocks of lines that can hold the records selected
+        by opts, as a list of (start, end, number of the first line).
+        """
+        count = len(self.offsets)
+        first, last = 0, count
+        if opts['since'] is not None:
+            first = max(bisect.bisect_left(self.times, key_ns(opts['since'])) - 1, 0)
+        if opts['until'] is not None:
+            last = bisect.bisect_left(self.times, key_ns(opts['until']))
+        if opts['lines']:
+            first = max(first, (opts['lines'][0] - 1) // self.interval)
+            if opts['lines'][1]:
+                last = min(last, (opts['lines'][1] - 1) // self.interval + 1)
+        bit = STREAM_BITS.get(opts['stream'], ALL_STREAMS)
+        ranges = []
+        for block in xrange(first, last):
+            if not self.streams[block] & bit:
+                continue
+            start = self.offsets[block]
+            end = self.offsets[block + 1] if block + 1 < count else self.size
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end, ranges[-1][2])
+            else:
+                ranges.append((start, end, block * self.interval + 1))
+        return ranges
+
+
+def build_indexes(args):
+    """Builds and saves the index of each of the files.
+    """
+    for path in args.files:
+        if compression(path):
+            sys.stderr.write('%s: compressed files cannot be indexed\n' % path)
+            continue
+        index = LogIndex.build(path, file_parser(path, DEFAULT_OPTS), args.index_interval)
+        index.save(path)
+        sys.stderr.write('%s: indexed %d lines in %d blocks\n' % (
+            path, index.lines, len(index.offsets)))
+
+
+def is_selective(opts):
+    """Returns True if opts select a part of each file rather than all of the records.
+    """
+    return any(opts[key] is not None for key in ['since', 'until', 'stream', 'lines'])
+
+
+def align_ranges(path, ranges, parser):
+    """Widens the byte ranges of a log file to whole records, so that none starts or ends
+    within the partial lines of a message, and merges the ranges that then overlap.
+    """
+    size = os.path.getsize(path)
+    if not parser.partial_lines or not size:
+        return ranges
+    with open(path, 'rb') as filep:
+        mem = mmap.mmap(filep.fileno(), 0, access=mmap.ACCESS_READ)
+    aligned = []
+    try:
+        for start, end, lineno in ranges:
+            while start > 0:
+                prev = mem.rfind('\n', 0, start - 1) + 1
+                if not parser.is_partial(mem[prev:start]):
+                    break
+                start = prev
+                lineno = lineno - 1 if lineno is not None else None
+            while 0 < end < size and parser.is_partial(mem[mem.rfind('\n', 0, end - 1) + 1:end]):
+                end = mem.find('\n', end) + 1 or size
+            if aligned and aligned[-1][1] >= start:
+                aligned[-1] = (aligned[-1][0], max(end, aligned[-1][1]), aligned[-1][2])
+            else:
+                aligned.append((start, end, lineno))
+    finally:
+        mem.close()
+    return aligned
+
+
+def file_ranges(path, opts, parser):
+    """Returns the byte ranges of an uncompressed log file that can hold the records selected
+    by opts, as a list of (start, end, number of the first line or None if it is not known).
+    The sidecar index is used if there is one, otherwise a time range is found by byte_range.
+    """
+    index = LogIndex.load(path)
+    if index:
+        return align_ranges(path, index.ranges(opts), parser)
+    size = os.path.getsize(path)
+    if opts['lines']:
+        return [(0, size, 1)]
+    start, end = byte_range(path, opts['since'], opts['until'], parser)
+    return align_ranges(path, [(start, end, None)], parser)
+
+
+def numbered_lines(path, opts, parser):
+    """Yields (line number, line) for the lines of a log file that can hold the records
+    selected by opts. The line number is None when it is not known.
+    Compressed files are read in full.
+    """
+    if compression(path) or not is_selective(opts):
+        with open_log(path) as filep:
+            for lineno, line in enumerate(filep, 1):
+                yield lineno, line
+        return
+    with open(path, 'rb') as filep:
+        for start, end, lineno in file_ranges(path, opts, parser):
+            filep.seek(start)
+            while start < end:
+                line = filep.readline()
+                if not line:
+                    break
+                start += len(line)
+                yield lineno, line
+                if lineno is not None:
+                    lineno += 1
+
+
+def select_lines(numbered, lines):
+    """Yields the lines of (line number, line) pairs, limited to the (first, last) line
+    numbers in lines if it is set.
+    """
+    if not lines:
+        for _, line in numbered:
+            yield line
+        return
+    first, last = lines
+    for lineno, line in numbered:
+        if last and lineno > last:
+            return
+        if lineno >= first:
+            yield line
+
+
+def log_lines(path, opts, parser):
+    """Yields the lines of a log file that can hold the records selected by opts.
+    """
+    return select_lines(numbered_lines(path, opts, parser), opts['lines'])
+
+
+def input_lines(files, opts):
+    """Yields the lines of each of the files in turn, or of stdin if there are none.
+    """
+    for path in files or ['-']:
+        if path == '-':
+            numbered = enumerate(sys.stdin, 1)
+            for line in select_lines(numbered, opts['lines']):
+                yield line
+            continue
+        for line in log_lines(path, opts, file_parser(path, opts)):
+            yield line
+
+
+def input_files(files, opts):
+    """Yields (source tag, records selected by opts) for each of the files in turn, or for
+    stdin, with the tag None, if there are none. The format of each file is detected separately.
+    """
+    for path in files or ['-']:
+        if path == '-':
+            first = sys.stdin.readline()
+            parser = detect_parser(first, opts)
+            numbered = enumerate(itertools.chain([first] if first else [], sys.stdin), 1)
+            lines = select_lines(numbered, opts['lines'])
+        else:
+            parser = file_parser(path, opts)
+            lines = log_lines(path, opts, parser)
+        yield source_tag(path) if path != '-' else None, log_records(lines, opts, parser)
+
+
+def required_literal(pattern):
+    """Returns a literal string that every match of a regular expression contains, and that
+    appears unchanged in the JSON encoded record, or None if there is no such string.
+    Only the leading literal characters of patterns without alternation are considered.
+    """
+    if '|' in pattern or '(?' in pattern:  # alternation or flags such as (?i)
+        return None
+    literal = []
+    for char in pattern:
+        if char in REGEXP_SPECIAL:
+            if char in '*?{' and literal:
+                literal.pop()
+            break
+        if char not in JSON_SAFE:
+            break
+        literal.append(char)
+    if len(literal) < 3:
+        return None
+    return ''.join(literal)
+
+
+def line_prefilter(opts, parser):
+    """Returns a function that cheaply rejects raw lines that cannot hold a record selected
+    by opts, before any decoding, or None if there is nothing to check.
+    The stream is checked by the parser of the file format, and the lines must contain a
+    literal required by one of the regular expressions.
+    """
+    checks = []
+    if opts['stream']:
+        checks.append(parser.stream_check(opts['stream']))
+    if opts['regexp'] and not opts['ignore_case']:
+        literals = [required_literal(pattern) for pattern in opts['regexp']]
+        if all(literals):
+            checks.append(lambda line: any(literal in line for literal in literals))
+    if not checks:
+        return None
+    if len(checks) == 1:
+        return checks[0]
+    return lambda line: all(check(line) for check in checks)
+
+
+def record_filter(opts, levels=None):
+    """Returns a function of a decoded record that is True if the record is selected by the
+    times, stream, level and regular expressions in opts, or None if all records are selected.
+    levels is the level of the last message of each stream, which the function updates. When
+    it is given the level of a stream that is missing from it is unknown, as at the start of
+    a -j chunk, and the function returns None for an otherwise selected message of that
+    stream that continues an earlier one.
+    """
+    since, until, stream, level = opts['since'], opts['until'], opts['stream'], opts['level']
+    matcher = None
+    if opts['regexp']:
+        # one alternation scans each message once, however many expressions there are
+        matcher = re.compile('|'.join('(?:%s)' % pattern for pattern in opts['regexp']),
+                             re.IGNORECASE if opts['ignore_case'] else 0).search
+    if since is None and until is None and stream is None and level is None and not matcher:
+        return None
+    min_level = LEVELS.index(level) if level else None
+    unknown = levels is not None
+    last_levels = levels if unknown else {}
+
+    def check(rec):
+        """Returns True if the record is selected"""
+        log, rec_stream, stamp = rec
+        if stream is not None and rec_stream != stream:
+            return False
+        if since is not None or until is not None:
+            key = time_key(stamp)
+            if (since is not None and key < since) or (until is not None and key >= until):
+                return False
+        undecided = False
+        if min_level is not None:
+            # a message without a level, eg in a stack trace, continues the previous one
+            match = LEVEL_RE.search(log, 0, LEVEL_SPAN)
+            if match:
+                last_levels[rec_stream] = LEVEL_NAMES[match.group(1)]
+            elif unknown and rec_stream not in last_levels:
+                undecided = True
+            if not undecided and last_levels.get(rec_stream, -1) < min_level:
+                return False
+        if matcher and not matcher(log):
+            return False
+        return None if undecided else True
+    return check
+
+
+def log_records(lines, opts, parser, final=True):
+    """Yields the decoded (log, stream, time) record of each message in the lines of one file,
+    skipping records that are not selected by opts. Lines that cannot match are rejected
+    before they are decoded. final is passed to the records method of the parser.
+    """
+    check = record_filter(opts)
+    records = parser.records(lines, line_prefilter(opts, parser) if check else None, final)
+    if not check:
+        for rec in records:
+            yield rec
+        return
+    for rec in records:
+        if check(rec):
+            yield rec
+
+
+def select_opts(args):
+    """Returns the options that select, decode and format records, as passed to worker
+    processes.
+    """
+    return dict((key, getattr(args, key)) for key in DEFAULT_OPTS)
+
+
+def time_key(stamp):
+    """Returns an RFC3339 timestamp in UTC with nanosecond precision.
+    The keys sort chronologically, unlike the variable precision RFC3339Nano times docker writes.
+    A stamp that cannot be parsed is returned unchanged.
+    """
+    if len(stamp) == 30 and stamp[-1] == 'Z':
+        return stamp
+    match = TIME_RE.match(stamp)
+    if not match:
+        return stamp
+    base, frac, zone = match.groups()
+    if zone != 'Z':
+        offset = datetime.timedelta(hours=int(zone[1:3]), minutes=int(zone[4:6]))
+        if zone[0] == '+':
+            offset = -offset
+        base = (datetime.datetime.strptime(base, TIME_FMT) + offset).strftime(TIME_FMT)
+    return '%s.%sZ' % (base, (frac or '')[:9].ljust(9, '0'))
+
+
+def key_ns(key):
+    """Returns a time key as nanoseconds since the epoch, or 0 if it is not a valid time.
+    """
+    if not TIME_RE.match(key):
+        return 0
+    return calendar.timegm(time.strptime(key[:19], TIME_FMT)) * 1000000000 + int(key[20:29])
+
+
+def time_arg(value):
+    """Converts a --since or --until argument to a time key. The argument is an RFC3339 time,
+    in UTC unless it has a zone offset, from which trailing fields may be omitted.
+    A space can be used instead of the T.
+    """
+    stamp = value.strip().replace(' ', 'T')
+    zone = 'Z'
+    match = re.search(r'(Z|[+-]\d\d:\d\d)$', stamp[10:])
+    if match:
+        zone = match.group()
+        stamp = stamp[:len(stamp) - len(zone)]
+    stamp, _, frac = stamp.partition('.')
+    fields = re.findall(r'^\d{4}|[-T:]\d\d', stamp)
+    if ''.join(fields) != stamp or not fields or (frac and len(fields) != 6):
+        raise argparse.ArgumentTypeError('invalid time: %s' % value)
+    fields.extend(TIME_ARG_FIELDS[len(fields):])
+    key = time_key(''.join(fields) + ('.' + frac if frac else '') + zone)
+    if not TIME_RE.match(key):
+        raise argparse.ArgumentTypeError('invalid time: %s' % value)
+    return key
+
+
+def line_range(value):
+    """Converts a --lines argument, FIRST:LAST where either may be omitted or a single line
+    number, to (first, last) with last None for the end of the file.
+    """
+    first, sep, last = value.partition(':')
+    try:
+        first = int(first) if first else 1
+        last = int(last) if last else (None if sep else first)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid line range: %s' % value)
+    if first < 1 or (last is not None and last < first):
+        raise argparse.ArgumentTypeError('invalid line range: %s' % value)
+    return first, last
+
+
+def source_tag(path):
+    """Returns the name that identifies the log file in merged output.
+    Rotated and compressed files of one container share a tag. Docker and containerd log file
+    names are replaced by the name of the directory they are in, which is the container name
+    when the files were downloaded by k8sgetlogs.py.
+    """
+    name = ROTATION_RE.sub('', os.path.basename(path), 1)
+    parent = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    if CONTAINER_LOG_RE.match(name) and parent:
+        return parent
+    return name
+
+
+def timed_records(path, index, opts):
+    """Yields (time key, index, tag, message, stream, time) for each record of one log file.
+    """
+    tag = source_tag(path)
+    parser = file_parser(path, opts)
+    for log, stream, stamp in log_records(log_lines(path, opts, parser), opts, parser):
+        yield time_key(stamp), index, tag, log, stream, stamp
+
+
+def view_merged(args, out):
+    """Writes the messages of all of the files as a single timeline ordered by the record
+    times, with each message prefixed by its source tag. Each file must be in time order,
+    as log files are, and only one record per file is held in memory.
+    """
+    opts = select_opts(args)
+    write = record_writer(args.output, out.write, True)
+    inputs = [timed_records(path, idx, opts) for idx, path in enumerate(args.files)]
+    for _, _, tag, log, stream, stamp in heapq.merge(*inputs):
+        write(log, stream, stamp, tag)
+
+
+class TailedFile(object):
+    """Follows a log file by name as it grows and is rotated.
+    When the name refers to a new file the rest of the old one is read before switching to the
+    new one, and a file that shrinks is assumed to have been truncated and is read again
+    from the start. Nothing that was read is read again. A last line of the old file that was
+    never completed is returned as it is before switching.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.filep = None
+        self.ino = None
+        self.partial = ''
+        self.reopen()
+
+    def reopen(self):
+        """Opens the file that currently has the name, if there is one"""
+        if self.filep:
+            self.filep.close()
+        self.filep = None
+        self.partial = ''
+        try:
+            self.filep = io.open(self.path, 'rb', buffering=0)
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            return
+        self.ino = os.fstat(self.filep.fileno()).st_ino
+
+    def drain(self):
+        """Returns the complete lines added to the open file since the last call"""
+        if not self.filep:
+            return []
+        data = self.filep.read()
+        if not data:
+            return []
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        return [line + '\n' for line in lines]
+
+    def cut_line(self):
+        """Returns the incomplete last line read from the file, which will not be completed
+        once the file was rotated or truncated, as a list of at most one line without a newline.
+        """
+        partial, self.partial = self.partial, ''
+        return [partial] if partial else []
+
+    def read_lines(self):
+        """Returns the new complete lines, following the name to a new file if it was rotated
+        """
+        lines = self.drain()
+        try:
+            stat = os.stat(self.path)
+        except OSError:  # rotated, and the new file is not there yet
+            return lines
+        if not self.filep or stat.st_ino != self.ino:
+            lines.extend(self.cut_line())
+            self.reopen()
+            lines.extend(self.drain())
+        elif stat.st_size < self.filep.tell():
+            lines.extend(self.cut_line())
+            self.filep.seek(0)
+            lines.extend(self.drain())
+        return lines
+
+
+class Inotify(object):
+    """Waits for files to change in a set of directories using inotify.
+    """
+
+    def __init__(self, dirs):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        for path in dirs:
+            if libc.inotify_add_watch(self.fd, path, IN_MODIFY | IN_MOVED_TO | IN_CREATE) < 0:
+                raise OSError(ctypes.get_errno(), 'cannot watch %s' % path)
+
+    def wait(self, timeout):
+        """Waits up to timeout seconds for an event, then discards all pending events"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+
+
+def file_waiter(paths):
+    """Returns a function that waits until any of the files may have changed.
+    inotify is used if it is available, otherwise the files are polled.
+    """
+    dirs = set(os.path.dirname(os.path.abspath(path)) for path in paths)
+    try:
+        inotify = Inotify(dirs)
+    except (OSError, AttributeError, TypeError):  # not linux, or too old
+        return lambda: time.sleep(FOLLOW_POLL_SEC)
+    return lambda: inotify.wait(FOLLOW_INOTIFY_SEC)
+
+
+def view_follow(args, out):
+    """Writes the messages of the files and then follows them, writing new messages as they
+    are appended until interrupted. With --merge each message is prefixed by its source tag.
+    """
+    opts = select_opts(args)
+    write = record_writer(args.output, out.write, args.merge)
+    tails = [(TailedFile(path), source_tag(path)) for path in args.files]
+    # the parser of each file is chosen when its first line is read, and then keeps the partial
+    # lines of messages that are not complete yet
+    parsers = [None] * len(tails)
+    wait = file_waiter(args.files)
+    try:
+        while True:
+            for idx, (tail, tag) in enumerate(tails):
+                lines = tail.read_lines()
+                if not lines:
+                    continue
+                parsers[idx] = parsers[idx] or detect_parser(lines[0], opts)
+                for log, stream, stamp in log_records(lines, opts, parsers[idx], final=False):
+                    write(log, stream, stamp, tag)
+            out.flush()
+            wait()
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+class OutputWriter(object):
+    """Collects output in memory and writes it to a file in large blocks, rather than making
+    a write call per message. The messages are written as the bytes that were in the log,
+    so there is no decoding and encoding and any bytes that are not valid UTF-8 are kept.
+    """
+
+    def __init__(self, filep, size=OUTPUT_BUFFER):
+        self.filep = filep
+        self.size = size
+        self.buf = []
+        self.buffered = 0
+
+    def write(self, data):
+        """Adds data to the output"""
+        self.buf.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.size:
+            self.flush()
+
+    def flush(self):
+        """Writes the collected output"""
+        if self.buf:
+            self.filep.write(''.join(self.buf))
+            self.buf = []
+            self.buffered = 0
+        self.filep.flush()
+
+
+def parse_message(log):
+    """Splits an agentd or nuvo message into (timestamp, level, module, message), with the
+    level spelled as in LEVELS. The first three are None for a message without the prefix,
+    eg a line of a stack trace.
+    """
+    log = log.rstrip('\n\r')
+    match = MESSAGE_RE.match(log)
+    if not match:
+        return None, None, None, log
+    stamp, level, module, msg = match.groups()
+    return stamp, LEVELS[LEVEL_NAMES[level]], module, msg
+
+
+def record_fields(log, stream, stamp, tag):
+    """Returns the RECORD_FIELDS of a record.
+    """
+    return (stamp, stream, tag) + parse_message(log)
+
+
+def json_record(log, stream, stamp, tag):
+    """Returns a record as one line of JSON. Bytes that are not valid UTF-8 are replaced.
+    """
+    fields = [field.decode('UTF-8', 'replace') if field is not None else None
+              for field in record_fields(log, stream, stamp, tag)]
+    return json.dumps(collections.OrderedDict(zip(RECORD_FIELDS, fields))) + '\n'
+
+
+def record_writer(output, write, tagged):
+    """Returns a function of (log, stream, time, source tag) that passes one record to write
+    in the output format: a line of text, prefixed by the tag if tagged is set, a line of
+    JSON, or the tuple of RECORD_FIELDS that a ParquetOutput takes.
+    """
+    if output == 'json':
+        return lambda log, stream, stamp, tag: write(json_record(log, stream, stamp, tag))
+    if output == 'parquet':
+        return lambda log, stream, stamp, tag: write(record_fields(log, stream, stamp, tag))
+    if tagged:
+        return lambda log, _stream, _stamp, tag: write('[%s] %s\n' % (tag, log.rstrip('\n\r')))
+    return lambda log, _stream, _stamp, _tag: write(log.rstrip('\n\r') + '\n')
+
+
+class ParquetOutput(object):
+    """Writes records to a Parquet file with a column per field of RECORD_FIELDS, so that
+    later analysis reads only the columns it needs. The records are written in row groups of
+    rows records, so memory use is bounded. The record time is stored as a timestamp and the
+    other fields as strings.
+    """
+
+    def __init__(self, path, rows=PARQUET_ROWS):
+        self.rows = rows
+        self.buf = []
+        self.schema = pyarrow.schema(
+            [pyarrow.field('time', pyarrow.timestamp('ns', tz='UTC'))] +
+            [pyarrow.field(name, pyarrow.string()) for name in RECORD_FIELDS[1:]])
+        # format version 2.0 keeps the nanoseconds of the record times
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, version='2.0')
+
+    def write(self, fields):
+        """Adds the RECORD_FIELDS of one record"""
+        self.buf.append(fields)
+        if len(self.buf) >= self.rows:
+            self.flush()
+
+    def flush(self):
+        """Writes the collected records as a row group"""
+        if not self.buf:
+            return
+        columns = zip(*self.buf)
+        self.buf = []
+        arrays = [pyarrow.array([key_ns(time_key(stamp)) or None for stamp in columns[0]],
+                                type=self.schema[0].type)]
+        for column in columns[1:]:
+            arrays.append(pyarrow.array(
+                [field.decode('UTF-8', 'replace') if field is not None else None
+                 for field in column], type=pyarrow.string()))
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        """Writes the rest of the records and completes the file"""
+        self.flush()
+        self.writer.close()
+
+
+def complete_lines(filep, parser):
+    """Reads the rest of the line that a read of filep cut, and the lines after it up to the
+    next complete line when the parser has partial lines. Returns what was read.
+    """
+    data = filep.readline()
+    # the line that was cut may be partial, so end after the next complete line
+    while parser.partial_lines:
+        line = filep.readline()
+        data += line
+        if not line or not parser.is_partial(line):
+            break
+    return data
+
+
+def split_file(path, chunk_size, opts):
+    """Splits the file_ranges of a file into ranges of about chunk_size bytes that start and
+    end on line boundaries. Yields (path, start, end, None).
+    A compressed file cannot be split, it is decompressed as a stream and its lines are
+    yielded in chunks of about chunk_size bytes as (path, offset, None, lines), so that only
+    the chunks being decoded are in memory.
+    """
+    parser = file_parser(path, opts)
+    if compression(path):
+        with open_log(path) as filep:
+            start = 0
+            while True:
+                data = filep.read(chunk_size)
+                if not data:
+                    break
+                data += complete_lines(filep, parser)
+                yield path, start, None, data
+                start += len(data)
+        return
+    if is_selective(opts):
+        ranges = file_ranges(path, opts, parser)
+    else:
+        ranges = [(0, os.path.getsize(path), None)]
+    with open(path, 'rb') as filep:
+        for start, size, _ in ranges:
+            while start < size:
+                filep.seek(start + chunk_size)
+                complete_lines(filep, parser)
+                end = min(filep.tell(), size)
+                yield path, start, end, None
+                start = end
+
+
+def decode_chunk(work):
+    """Decodes the lines of one chunk of a file in a worker process.
+    work is (path, start, end, data, first, opts), where data is None for the byte range from
+    start to end of the file, or the lines of a compressed file, first is set for the first
+    chunk of the file and opts are the select_opts.
+    Returns (records, undecided, levels, first). The records are in the output format, as
+    text or a list of RECORD_FIELDS. With a --level the level of each stream at the start of
+    the chunk is not known here: undecided lists the (index, stream) of the records that
+    continue a message before the chunk, the records are then a list of one item per record,
+    and levels is the level of the last message of each stream in the chunk. Before the first
+    chunk of a file no stream has a level.
+    """
+    path, start, end, data, first, opts = work
+    parser = file_parser(path, opts)
+    tag = source_tag(path)
+    if data is not None:
+        lines = data.split('\n')
+    else:
+        with open(path, 'rb') as filep:
+            filep.seek(start)
+            lines = filep.read(end - start).split('\n')
+    if not lines[-1]:
+        lines.pop()
+    items = []
+    write = record_writer(opts['output'], items.append, False)
+    undecided, levels = [], None
+    if opts['level']:
+        levels = {}
+        check = record_filter(opts, levels)
+        for rec in parser.records(lines, line_prefilter(opts, parser)):
+            selected = check(rec)
+            if selected is None:
+                undecided.append((len(items), rec[1]))
+            elif not selected:
+                continue
+            write(rec[0], rec[1], rec[2], tag)
+    else:
+        for log, stream, stamp in log_records(lines, opts, parser):
+            write(log, stream, stamp, tag)
+    if opts['output'] != 'parquet' and not undecided:
+        items = ''.join(items)
+    return items, undecided, levels, first
+
+
+def ordered_imap(pool, func, work, window):
+    """Like pool.imap, but with at most window results outstanding, so memory stays bounded
+    when the output is slower than the workers.
+    """
+    pending = collections.deque()
+    for item in work:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def view_parallel(args, out):
+    """Decodes byte ranges of the files in a pool of args.jobs worker processes and writes the
+    messages in the original file and line order.
+    """
+    opts = select_opts(args)
+    # generated as the results are written, so that compressed files are read as they are needed
+    work = (chunk + (not idx, opts) for path in args.files
+            for idx, chunk in enumerate(split_file(path, args.chunk_size << 20, opts)))
+    pool = multiprocessing.Pool(args.jobs)
+    min_level = LEVELS.index(args.level) if args.level else None
+    levels = {}
+    for data, undecided, chunk_levels, first in ordered_imap(pool, decode_chunk, work,
+                                                             2 * args.jobs):
+        if first:
+            levels = {}
+        if undecided:
+            # the records that continue a message of the chunks before, selected by its level
+            dropped = set(idx for idx, stream in undecided if levels.get(stream, -1) < min_level)
+            data = [item for idx, item in enumerate(data) if idx not in dropped]
+            if opts['output'] != 'parquet':
+                data = ''.join(data)
+        if chunk_levels:
+            levels.update(chunk_levels)
+        if opts['output'] == 'parquet':
+            for fields in data:
+                out.write(fields)
+        else:
+            out.write(data)
+    pool.close()
+    pool.join()
+
+
+def time_loop(decode, files):
+    """Decodes every line of the files. Returns (lines, seconds).
+    """
+    lines = 0
+    start = time.time()
+    for line in input_lines(files, DEFAULT_OPTS):
+        decode(line)
+        lines += 1
+    return lines, time.time() - start
+
+
+def benchmark(files):
+    """Checks decode_line against json.loads on SELF_TEST_CORPUS and every line of the files,
+    then reports the throughput of both decoders. Returns the number of mismatches.
+    """
+    mismatches = 0
+    inputs = [('corpus', SELF_TEST_CORPUS)]
+    for path in [path for path in files if path != '-']:
+        if not isinstance(file_parser(path, DEFAULT_OPTS), DockerParser):
+            sys.stderr.write('%s: skipped, the decoders only read docker JSON logs\n' % path)
+            files.remove(path)
+    if files:
+        inputs.append(('files', input_lines(files, DEFAULT_OPTS)))
+    for name, lines in inputs:
+        for lineno, line in enumerate(lines, 1):
+            if decode_line(line) != decode_json(line):
+                mismatches += 1
+                sys.stderr.write('%s line %d: mismatch: %r\n' % (name, lineno, line))
+    if not files:
+        return mismatches
+    for name in ['json', 'fast']:
+        lines, secs = time_loop(DECODERS[name], files)
+        print '%-5s %10d lines %8.3f sec %12.0f lines/sec' % (
+            name, lines, secs, lines / secs if secs else 0.0)
+    return mismatches
+
+
+def main():
+    """main
+    """
+    parser = argparse.ArgumentParser(
+        description='Outputs the messages of docker JSON or CRI log files like kubectl logs')
+    parser.add_argument('files', nargs='*',
+                        help='Log files to read, in order. Reads stdin if none are given')
+    parser.add_argument('--format', choices=['auto'] + list(PARSERS), default='auto',
+                        help='The format of the files. auto detects the format of each file from '
+                        'its first line. Default: auto')
+    parser.add_argument('--decoder', choices=sorted(DECODERS), default='fast',
+                        help='How docker JSON records are decoded. fast extracts the log field '
+                        'with a scanner and falls back to json for records it cannot handle. '
+                        'Default: fast')
+    parser.add_argument('--since', type=time_arg,
+                        help='Only output records at or after this time, eg 2019-02-01T10:05, '
+                        'in UTC unless a zone offset is given. The start of each uncompressed '
+                        'file is found with a binary search')
+    parser.add_argument('--until', type=time_arg,
+                        help='Only output records before this time')
+    parser.add_argument('--stream', choices=sorted(STREAM_BITS),
+                        help='Only output records of this stream')
+    parser.add_argument('-l', '--level', choices=LEVELS, type=str.upper,
+                        help='Only output messages of this level or more severe. Messages '
+                        'without a level take the level of the message before them')
+    parser.add_argument('-e', '--regexp', action='append',
+                        help='Only output messages that match this regular expression. Can be '
+                        'repeated to output messages that match any of them')
+    parser.add_argument('-i', '--ignore-case', action='store_true',
+                        help='Ignore case when matching --regexp')
+    parser.add_argument('--lines', type=line_range, metavar='FIRST:LAST',
+                        help='Only output these lines of each file, numbered from 1. '
+                        'Either number may be omitted')
+    parser.add_argument('--build-index', action='store_true',
+                        help='Build a sidecar index of each file instead of outputting it. '
+                        'The index is used to select records by time, line or stream until '
+                        'the file changes')
+    parser.add_argument('--index-interval', type=int, default=INDEX_INTERVAL,
+                        help='Index every this many lines. Default: %d' % INDEX_INTERVAL)
+    parser.add_argument('-f', '--follow', action='store_true',
+                        help='Keep following the files as they grow and are rotated, like '
+                        'kubectl logs -f. The files may not be compressed')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Decode the files in this many worker processes. Default: 1')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE >> 20,
+                        help='With --jobs, files are split into ranges of about this many MB '
+                        'that are decoded independently. Default: %d' % (CHUNK_SIZE >> 20))
+    parser.add_argument('-m', '--merge', action='store_true',
+                        help='Merge the files into a single timeline using the record times, '
+                        'with each message prefixed by the container or file it came from')
+    parser.add_argument('-o', '--output', choices=['text', 'json', 'parquet'], default='text',
+                        help='text outputs the messages. json outputs a JSON object per line, '
+                        'and parquet a Parquet file, with the time and stream of each record, '
+                        'its source and the timestamp, level, module and text of the message. '
+                        'parquet requires pyarrow and --output-file. Default: text')
+    parser.add_argument('--output-file',
+                        help='Write the output to this file instead of stdout')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Verify the fast decoder against json on a built-in corpus and '
+                        'the files, then report the throughput of each decoder')
+    args = parser.parse_args()
+
+    # Exit quietly when stdout is a pipe that closes, eg into head, instead of checking each write
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    if args.benchmark:
+        sys.exit(1 if benchmark(args.files) else 0)
+    named = args.files and '-' not in args.files
+    if (args.merge or args.build_index or args.follow) and not named:
+        parser.error('--merge, --build-index and --follow require named files')
+    if args.follow and (args.lines or any(compression(path) for path in args.files
+                                          if os.path.exists(path))):
+        parser.error('--follow cannot be used with --lines or compressed files')
+    if args.output == 'parquet' and not (pyarrow and args.output_file and not args.follow):
+        parser.error('--output parquet requires the pyarrow module and --output-file, and '
+                     'cannot be used with --follow')
+    if args.index_interval < 1:
+        parser.error('--index-interval must be positive')
+    if args.build_index:
+        build_indexes(args)
+        return
+    if args.output == 'parquet':
+        out = ParquetOutput(args.output_file)
+    else:
+        out = OutputWriter(open(args.output_file, 'wb') if args.output_file else sys.stdout)
+    # line numbers are not known within the byte ranges decoded by the workers
+    if args.jobs > 1 and named and not (args.merge or args.lines or args.follow):
+        view_parallel(args, out)
+    elif args.follow:
+        view_follow(args, out)
+    elif args.merge:
+        view_merged(args, out)
+    else:
+        write = record_writer(args.output, out.write, False)
+        for tag, records in input_files(args.files, select_opts(args)):
+            for log, stream, stamp in records:
+                write(log, stream, stamp, tag)
+    if args.output == 'parquet':
+        out.close()
+    else:
+        out.flush()
+
+
+if __name__ == '__main__':
+    main()
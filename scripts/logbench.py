@@ -0,0 +1,383 @@
+#! /usr/bin/env python2.7
+"""
+Copyright 2019 Tad Lebeck
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+"""
+Usage: logbench.py [--size MB] [--only NAME] [--baseline FILE [--save-baseline]]
+
+Measures the throughput and peak memory use of the log tools in this directory on synthetic logs:
+docker JSON and containerd CRI container logs for k8slogview.py, and agentd.log and agentd-json.log
+files full of NUVOAPI calls for agentdlog2cmd.py.
+Results can be saved as a baseline, and later runs report regressions against it.
+
+See the README.md for more information.
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# default size of each generated log file, in MB
+DEFAULT_SIZE = 20
+
+# a run is a regression if it is this much slower or bigger than the baseline
+DEFAULT_TOLERANCE = 0.1
+
+# start time of the generated logs, seconds since the epoch (2019-02-01T00:00:00Z)
+START_TIME = 1548979200
+
+# NUVOAPI calls made when a volume is configured and used, with the params of each call
+VOLUME_CALLS = [
+    ('CreateLogVol', ['{vol}', '{dev}', '{parcel}', '{size}']),
+    ('AllocParcels', ['{vol}', '{dev}', '4']),
+    ('AllocCache', ['{vol}', '8']),
+    ('ExportLun', ['{vol}', '', '{vol}', 'true']),
+    ('PauseIo', ['{vol}']),
+    ('CreatePit', ['{vol}', '{pit}']),
+    ('ResumeIo', ['{vol}']),
+    ('ExportLun', ['{vol}', '{pit}', '{pit}', 'false']),
+    ('UnexportLun', ['{vol}', '{pit}', '{pit}']),
+    ('DeletePit', ['{vol}', '{pit}']),
+    ('UnexportLun', ['{vol}', '', '{vol}']),
+    ('CloseVol', ['{vol}']),
+    ('OpenVol', ['{vol}', '{dev}', '{parcel}']),
+]
+
+# messages that make up most of agentd.log, with the odds of each
+NOISE = [
+    (30, 'INFO', 'vreq', 'VolumeSeriesRequest {uuid} processing state CONFIGURING'),
+    (20, 'DEBUG', 'heartbeat', 'node {uuid} heartbeat sent, {num} volumes'),
+    (10, 'INFO', 'csi', 'NodePublishVolume volume_id:"{uuid}" target_path:"/var/lib/kubelet/'
+     'pods/{uuid}/volumes/kubernetes.io~csi/pvc-{uuid}/mount"'),
+    (5, 'WARNING', 'vreq', 'volumeSeriesRequestState {uuid} retry {num}'),
+    (3, 'ERROR', 'mgmt', 'failed to update storage {uuid}: "timeout"\n\tretrying'),
+]
+
+
+def uuid(rnd):
+    """Returns a random UUID string"""
+    return '%08x-%04x-%04x-%04x-%012x' % (rnd.getrandbits(32), rnd.getrandbits(16),
+                                          rnd.getrandbits(16), rnd.getrandbits(16),
+                                          rnd.getrandbits(48))
+
+
+def call_lines(rnd, api, params, fail_odds=0.02):
+    """Returns the agentd messages of one NUVOAPI call and its completion"""
+    call = 'NUVOAPI %s(%s)' % (api, ', '.join(params))
+    if rnd.random() < fail_odds:
+        return [('INFO', call), ('ERROR', '%s failed: nuvo api error: %s' % (
+            call, rnd.choice(['No such volume', 'Device busy', 'Timed out'])))]
+    return [('INFO', call), ('INFO', '%s succeeded' % call)]
+
+
+def agentd_messages(rnd, noise_odds=0.85):
+    """Yields (level, module, message) for the messages of an endless series of nuvo runs.
+    Most messages are not NUVOAPI calls, as in a real agentd.log.
+    """
+    noise = []
+    for odds, level, module, msg in NOISE:
+        noise.extend([(level, module, msg)] * odds)
+    while True:
+        node = uuid(rnd)
+        devs = [(uuid(rnd), '/dev/xvd%s' % chr(ord('b') + idx)) for idx in range(4)]
+        vols = [uuid(rnd) for _ in range(rnd.randint(4, 16))]
+        addr = '172.20.%d.%d' % (rnd.randint(0, 255), rnd.randint(1, 254))
+        calls = [('UseNodeUUID', [node])]
+        calls.append(('NodeLocation', [node, addr, '32145']))
+        for dev_uuid, dev in devs:
+            calls.append(('FormatDevice', [dev_uuid, dev, '1073741824']))
+            calls.append(('UseDevice', [dev_uuid, dev]))
+            calls.append(('DeviceLocation', [dev_uuid, node]))
+        calls.append(('UseCacheDevice', [uuid(rnd), '/dev/nvme0n1']))
+        for _ in range(rnd.randint(50, 200)):
+            vol = rnd.choice(vols)
+            for api, params in VOLUME_CALLS[:rnd.randint(1, len(VOLUME_CALLS))]:
+                fields = {'vol': vol, 'dev': rnd.choice(devs)[0], 'pit': uuid(rnd),
+                          'parcel': str(rnd.randint(0, 9)), 'size': str(rnd.randint(1, 64) << 30)}
+                calls.append((api, [param.format(**fields) for param in params]))
+        yield 'INFO', 'nuvoapi', 'Successfully set nuvo service node UUID [%s]' % node
+        for api, params in calls:
+            while rnd.random() < noise_odds:
+                level, module, msg = rnd.choice(noise)
+                yield level, module, msg.format(uuid=rnd.choice(vols), num=rnd.randint(0, 99))
+            if rnd.random() < 0.2:
+                for kind, obj_uuid in [('Storage', rnd.choice(devs)[0]),
+                                       ('Volume', rnd.choice(vols))]:
+                    for direction in ['READ', 'WRITE']:
+                        count = rnd.randint(0, 1 << 20)
+                        yield 'INFO', 'metrics', 'NUVOAPI Metrics on %s %s %s {%d %d %d %d}' % (
+                            kind, obj_uuid, direction, count,
+                            count * rnd.choice([4096, 8192, 65536]), rnd.randint(0, 1000),
+                            rnd.randint(0, 1000))
+            for level, msg in call_lines(rnd, api, params):
+                yield level, 'nuvoapi', msg
+        if rnd.random() < 0.5:
+            yield 'ERROR', 'nuvoapi', 'NUVOAPI NOT INITIALIZED'
+
+
+def timestamps(rnd):
+    """Yields increasing times, in seconds since the epoch"""
+    now = START_TIME
+    while True:
+        now += rnd.expovariate(200.0)
+        yield now
+
+
+def rfc3339nano(stamp):
+    """Formats a time the way docker and containerd do, with trailing zeros dropped"""
+    frac = ('%.9f' % (stamp % 1))[2:].rstrip('0')
+    frac = '.' + frac if frac else ''
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(stamp)) + frac + 'Z'
+
+
+def agentd_time(stamp):
+    """Formats a time the way agentd does"""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(stamp)) + ('%.6f' % (stamp % 1))[1:] + 'Z'
+
+
+def agentd_lines(rnd):
+    """Yields (time, stream, line) for the lines of an agentd.log. A message with embedded
+    newlines is yielded as several lines, as a container runtime records it.
+    """
+    for stamp, (level, module, msg) in itertools.izip(timestamps(rnd), agentd_messages(rnd)):
+        stream = 'stderr' if level in ['WARNING', 'ERROR'] else 'stdout'
+        text = '%s %s %s %s\n' % (agentd_time(stamp), level, module, msg)
+        for line in text.splitlines(True):
+            yield stamp, stream, line
+
+
+def write_until(path, size, lines):
+    """Writes lines to a file until it holds at least size bytes. Returns the number of lines.
+    """
+    count = 0
+    written = 0
+    with open(path, 'wb') as filep:
+        for line in lines:
+            filep.write(line)
+            written += len(line)
+            count += 1
+            if written >= size:
+                break
+    return count
+
+
+def gen_agentd(path, size, rnd):
+    """Generates an agentd.log"""
+    return write_until(path, size, (line for _, _, line in agentd_lines(rnd)))
+
+
+def docker_lines(rnd):
+    """Yields the lines of a docker JSON log of agentd"""
+    for stamp, stream, line in agentd_lines(rnd):
+        yield json.dumps({'log': line, 'stream': stream, 'time': rfc3339nano(stamp)},
+                         separators=(',', ':')) + '\n'
+
+
+def gen_docker(path, size, rnd):
+    """Generates a docker JSON log, which is also what an agentd-json.log is"""
+    return write_until(path, size, docker_lines(rnd))
+
+
+def cri_lines(rnd, max_line=2048):
+    """Yields the lines of a containerd CRI log of agentd, splitting long messages into
+    partial lines as containerd does
+    """
+    for stamp, stream, line in agentd_lines(rnd):
+        if rnd.random() < 0.01:
+            line = line[:-1] + ' ' + 'x' * rnd.randint(max_line, 3 * max_line) + '\n'
+        while len(line) > max_line:
+            yield '%s %s P %s\n' % (rfc3339nano(stamp), stream, line[:max_line])
+            line = line[max_line:]
+        yield '%s %s F %s' % (rfc3339nano(stamp), stream, line)
+
+
+def gen_cri(path, size, rnd):
+    """Generates a containerd CRI log"""
+    return write_until(path, size, cri_lines(rnd))
+
+
+# name: (file name, generator)
+LOGS = {
+    # a docker container log is named after the 64 hex digit container id
+    'docker': ('0123456789abcdef' * 4 + '-json.log', gen_docker),
+    'cri': ('0.log', gen_cri),
+    'agentd': ('agentd.log', gen_agentd),
+    'agentd-json': ('agentd-json.log', gen_docker),
+}
+
+# name: (log, command line); the command is run with the log file path appended
+BENCHMARKS = [
+    ('k8slogview', 'docker', ['k8slogview.py']),
+    ('k8slogview-jobs', 'docker', ['k8slogview.py', '-j', str(multiprocessing.cpu_count())]),
+    ('k8slogview-filter', 'docker', ['k8slogview.py', '-e', 'NUVOAPI CreatePit']),
+    ('k8slogview-cri', 'cri', ['k8slogview.py']),
+    ('agentdlog2cmd', 'agentd', ['agentdlog2cmd.py']),
+    ('agentdlog2cmd-json', 'agentd-json', ['agentdlog2cmd.py']),
+]
+
+
+def generate(workdir, size, seed, names):
+    """Generates the named logs in workdir. Returns {name: (path, lines)}.
+    """
+    logs = {}
+    for name in names:
+        file_name, gen = LOGS[name]
+        path = os.path.join(workdir, file_name)
+        start = time.time()
+        lines = gen(path, size, random.Random(seed))
+        logs[name] = (path, lines)
+        sys.stderr.write('generated %s: %d lines, %d bytes in %.1f sec\n' % (
+            path, lines, os.path.getsize(path), time.time() - start))
+    return logs
+
+
+def run(cmd):
+    """Runs a command with its output discarded.
+    Returns (exit status, wall seconds, peak RSS in KB).
+    """
+    with open(os.devnull, 'wb') as devnull:
+        start = time.time()
+        proc = subprocess.Popen(cmd, stdout=devnull, stderr=devnull)
+        _, status, usage = os.wait4(proc.pid, 0)
+        secs = time.time() - start
+    proc.returncode = status
+    return os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1, secs, usage.ru_maxrss
+
+
+def measure(logs, repeat, only):
+    """Runs the benchmarks, each repeat times keeping the fastest run.
+    Returns {name: {'lines_per_sec': ..., 'max_rss_kb': ...}}, with 'error' set instead for a
+    benchmark whose command failed.
+    """
+    results = {}
+    for name, log, cmd in BENCHMARKS:
+        if only and name not in only:
+            continue
+        path, lines = logs[log]
+        cmd = [sys.executable, os.path.join(SCRIPT_DIR, cmd[0])] + cmd[1:] + [path]
+        runs = []
+        for _ in range(repeat):
+            status, secs, rss = run(cmd)
+            if status:
+                results[name] = {'error': 'exit status %d' % status}
+                break
+            runs.append((secs, rss))
+        else:
+            secs, rss = min(runs)
+            results[name] = {'lines_per_sec': lines / secs, 'max_rss_kb': rss}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Prints the results next to the baseline. Returns the number of regressions.
+    """
+    regressions = 0
+    print '%-20s %14s %14s %10s %10s  %s' % (
+        'benchmark', 'lines/sec', 'baseline', 'RSS MB', 'baseline', 'status')
+    for name, _, _ in BENCHMARKS:
+        if name not in results:
+            continue
+        result = results[name]
+        if 'error' in result:
+            print '%-20s %s' % (name, result['error'])
+            continue
+        base = baseline.get(name, {})
+        status = []
+        if 'lines_per_sec' in base:
+            if result['lines_per_sec'] < base['lines_per_sec'] * (1 - tolerance):
+                status.append('SLOWER')
+            elif result['lines_per_sec'] > base['lines_per_sec'] * (1 + tolerance):
+                status.append('faster')
+        if 'max_rss_kb' in base and result['max_rss_kb'] > base['max_rss_kb'] * (1 + tolerance):
+            status.append('BIGGER')
+        regressions += len([item for item in status if item.isupper()])
+        print '%-20s %14.0f %14s %10.1f %10s  %s' % (
+            name, result['lines_per_sec'],
+            '%.0f' % base['lines_per_sec'] if 'lines_per_sec' in base else '-',
+            result['max_rss_kb'] / 1024.0,
+            '%.1f' % (base['max_rss_kb'] / 1024.0) if 'max_rss_kb' in base else '-',
+            ' '.join(status) or 'ok')
+    return regressions
+
+
+def main():
+    """main
+    """
+    parser = argparse.ArgumentParser(
+        description='Measures the log tools on synthetic logs and compares them to a baseline')
+    parser.add_argument('--size', type=int, default=DEFAULT_SIZE,
+                        help='Size of each generated log in MB. Default: %d' % DEFAULT_SIZE)
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Random seed, the same seed generates the same logs. Default: 1')
+    parser.add_argument('--only', action='append', choices=[name for name, _, _ in BENCHMARKS],
+                        help='Run only this benchmark. Can be repeated')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Run each benchmark this many times and keep the fastest. Default: 3')
+    parser.add_argument('--workdir',
+                        help='Generate the logs in this directory and keep them. '
+                        'Default: a temporary directory that is removed')
+    parser.add_argument('--generate-only', action='store_true',
+                        help='Generate the logs in --workdir without running any benchmark')
+    parser.add_argument('--baseline',
+                        help='JSON file of baseline results to compare to')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Save the results as the new --baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Fraction by which a result may be worse than the baseline before '
+                        'it is a regression. Default: %.2f' % DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+    if (args.generate_only and not args.workdir) or (args.save_baseline and not args.baseline):
+        parser.error('--generate-only requires --workdir and --save-baseline requires --baseline')
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='logbench.')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    names = set(LOGS) if args.generate_only else set(
+        log for name, log, _ in BENCHMARKS if not args.only or name in args.only)
+    try:
+        logs = generate(workdir, args.size << 20, args.seed, sorted(names))
+        if args.generate_only:
+            return
+        results = measure(logs, args.repeat, args.only)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    baseline = {}
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as filep:
+            baseline = json.load(filep)
+    regressions = compare(results, {} if args.save_baseline else baseline, args.tolerance)
+    if args.save_baseline:
+        baseline.update((name, result) for name, result in results.items()
+                        if 'error' not in result)
+        with open(args.baseline, 'w') as filep:
+            json.dump(baseline, filep, indent=4, sort_keys=True)
+            filep.write('\n')
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()